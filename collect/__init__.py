@@ -1,22 +1,52 @@
 import os
 import sys
+import threading
 import pandas as pd
-from datetime import datetime, timedelta
+from datetime import datetime
 
 import sqlalchemy
-from sqlalchemy.engine.url import URL
 from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy import Column, ForeignKey, DateTime, String, Text
+from sqlalchemy import (Column, ForeignKey, DateTime, Float, Index, Integer,
+                        String, Text)
 from sqlalchemy.ext.declarative import declarative_base
 
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .cache import get_cache_engine, create_cache_schema, compile_cache
+from .coverage import CoverageIndex
+from .dtypes import normalize_dtypes
+from .mentions import count_mentions
+from .ratelimit import get_throttle, response_status
+from .sentiment import score_sentiment
+from .storage import STORAGE_BACKENDS, SQLiteStorage
 
 
 class DataCollector(ABC):
 
+    # number of rows sent to the cache per executemany call
+    upsert_chunk_size = 5000
+
+    # whether a single download can serve several keywords
+    shares_keywords = False
+
+    # compact dtypes of the columns of the downloaded and cached data
+    column_dtypes = {'keyword': 'category'}
+
+    # host the requests are sent to. collectors requesting the same host
+    # share its rate limit and retry budget. the collector name is used if
+    # this is None
+    request_host = None
+
+    # whether download_to_dataframe throttles each of its requests through
+    # request, rather than the whole download being a single request
+    throttles_requests = False
+
     def __init__(self, collector_name=None, keyword=None, start_date=None,
                  end_date=None, sample_interval=None, data_resolution=None,
-                 cache_name='cache.sqlite'):
+                 cache_name='cache.sqlite', max_workers=1, request_rate=None,
+                 request_burst=None, max_retries=None, storage='sqlite',
+                 keywords=None):
 
         # setting class attributes
         self.collector_name = collector_name
@@ -25,18 +55,36 @@ class DataCollector(ABC):
         # converst keyword to lowercase to avoid duplicate searches
         self.keyword = keyword.lower()
 
+        # keywords that share each download with this collector's keyword.
+        # collectors that download them together cache and cover them all
+        self.keywords = [self.keyword]
+        for other_keyword in (keywords or []):
+            if other_keyword.lower() not in self.keywords:
+                self.keywords.append(other_keyword.lower())
+
         # convert dates to datetime objects if they arent already
         self.start_date = start_date
         self.end_date = end_date
         # if self.end_date > datetime.utcnow():
         #     self.end_date = datetime.utcnow()
 
+        # number of intervals that are downloaded at the same time, and the
+        # maximum number of requests per second, the burst of requests and
+        # the retries allowed by the host
+        self.max_workers = max_workers
+        self.throttle = get_throttle(self.request_host or collector_name,
+                                     request_rate, request_burst,
+                                     max_retries)
+        self.cache_lock = threading.RLock()
+
         # convert times to datetime timedelta objects
         self.sample_interval = pd.to_timedelta(sample_interval)
         self.data_resolution = pd.to_timedelta(data_resolution)
 
-        # initialize sqlite database for caching downloaded data
-        self.cache_engine = self.create_cache_engine()
+        # initialize sqlite database for caching downloaded data. the engine
+        # is shared by every collector using the same cache
+        self.cache_path = self.get_cache_path()
+        self.cache_engine = get_cache_engine(self.cache_path)
 
         # create cache database session to access sqlite caceh
         Session = sessionmaker(bind=self.cache_engine)
@@ -50,12 +98,15 @@ class DataCollector(ABC):
         self.define_cache_coverage_table(Base)
 
         # add tables to the database
-        Base.metadata.create_all(self.cache_engine)
+        create_cache_schema(self.cache_path, Base.metadata)
 
         # defining query limits based on the epoch and interval so that they
         # are consistent regardless of the specified start date
         self.epoch = datetime.utcfromtimestamp(0)
 
+        # backend used to store the downloaded data and coverage
+        self.storage = STORAGE_BACKENDS[storage](self)
+
         # get the intervals that have already been queried previously and are
         # in the sqlite cache
         self.load_coverage()
@@ -67,23 +118,149 @@ class DataCollector(ABC):
 
     def query_data(self):
 
-        # obtain set of intervals to query
-        intervals = self.download_intervals()
-
-        # loop through each interval and compile a dataset
-        for interval_start, interval_end in intervals:
-
-            # query the specified interval
-            self.query_interval(interval_start, interval_end)
+        # download any intervals that are missing from the cache
+        intervals = self.download_data()
 
         # load full dataset from sqlite database
         self.status('LOADING FROM CACHE', self.start_date, self.end_date)
-        keyword_df = self.sql_to_dataframe(intervals[0][0], intervals[-1][-1])
+        keyword_df = self.storage.read(*self.read_bounds(intervals))
 
         self.next_status()
 
         return keyword_df
 
+    def read_bounds(self, intervals):
+        # the downloaded intervals are clipped to the gaps in the coverage,
+        # so the dates are included in case the first or last interval was
+        # only partially downloaded
+        if not intervals:
+            return self.start_date, self.end_date
+
+        return (min(intervals[0][0], self.start_date),
+                max(intervals[-1][-1], self.end_date))
+
+    def download_data(self):
+
+        # obtain set of intervals to query
+        intervals = self.download_intervals()
+
+        if self.max_workers > 1:
+
+            # download several intervals at once
+            intervals = list(intervals)
+            self.query_intervals_concurrently(intervals)
+
+        else:
+
+            # loop through each interval and compile a dataset. the intervals
+            # may be planned as they are downloaded
+            planned = []
+            for interval_start, interval_end in intervals:
+
+                # query the specified interval
+                self.query_interval(interval_start, interval_end)
+                planned.append([interval_start, interval_end])
+
+            intervals = planned
+
+        # return the intervals that make up the dataset
+        return intervals
+
+    def query_intervals_concurrently(self, intervals):
+
+        # skip the intervals that are already in the cache
+        pending = []
+        for interval_start, interval_end in intervals:
+            if self.is_cache_complete(interval_start, interval_end):
+                self.status('FOUND IN CACHE', interval_start, interval_end)
+            else:
+                pending.append((interval_start, interval_end))
+
+        # download the intervals on a bounded pool of workers. the downloaded
+        # data is written to the cache from this thread only, as each
+        # download completes
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.fetch_interval, *interval):
+                       interval for interval in pending}
+
+            for future in as_completed(futures):
+                interval_start, interval_end = futures[future]
+
+                try:
+                    cache_df = future.result()
+
+                # catch the exception and pass to child class
+                except Exception as error:
+
+                    # update status source and display status
+                    self.status('DOWNLOAD FAILED', interval_start,
+                                interval_end)
+
+                    cache_df = self.handle_download_error(interval_start,
+                                                          interval_end, error)
+
+                # only intervals that were downloaded are marked as covered
+                if cache_df is not None:
+                    self.status('DOWNLOADING TO CACHE', interval_start,
+                                interval_end)
+                    self.cache_interval(interval_start, interval_end,
+                                        cache_df)
+
+    def fetch_interval(self, interval_start, interval_end):
+        def on_retry(error, delay):
+            self.status('RETRYING IN {0:.0f}S'.format(delay), interval_start,
+                        interval_end)
+
+        # collectors sending several requests per interval throttle each of
+        # them. otherwise the download is throttled as a single request
+        # download_to_dataframe is defined by child class
+        if self.throttles_requests:
+            data_df = self.download_to_dataframe(interval_start, interval_end)
+        else:
+            data_df = self.request(self.resume_download, interval_start,
+                                   interval_end,
+                                   self.covered_until(interval_start,
+                                                      interval_end),
+                                   on_retry=on_retry)
+
+        return self.normalize_dtypes(data_df)
+
+    def resume_download(self, interval_start, interval_end, checkpoint):
+        # a retried download resumes from the end of the chunks it cached
+        # before it failed, such as streamed comments, rather than from the
+        # start of the interval
+        resume_start = self.covered_until(interval_start, interval_end)
+        if resume_start <= checkpoint:
+            resume_start = interval_start
+
+        return self.download_to_dataframe(resume_start, interval_end)
+
+    def covered_until(self, interval_start, interval_end):
+        # end of the coverage holding the start of the interval, or the start
+        # itself if it is not covered
+        with self.cache_lock:
+            return self.coverage.clip(interval_start, interval_end)[0]
+
+    def request(self, function, *args, on_retry=None):
+        # the request waits for the host's rate limiter and failed requests
+        # are retried with a backoff while the host's retry budget lasts
+        return self.throttle.call(function, *args,
+                                  retryable=self.is_retryable,
+                                  on_retry=on_retry)
+
+    def is_retryable(self, error):
+        # throttled requests, server errors and dropped connections are
+        # retried. other errors are passed to handle_download_error
+        status = response_status(error)
+        if status is not None:
+            return status == 429 or status >= 500
+
+        return isinstance(error, OSError)
+
+    def normalize_dtypes(self, data_df):
+        # convert the columns to the dtypes declared by the collector
+        return normalize_dtypes(data_df, self.column_dtypes)
+
     def status(self, message, interval_start, interval_end):
         self.source = message
 
@@ -140,8 +317,7 @@ class DataCollector(ABC):
             self.status('DOWNLOADING TO CACHE', interval_start, interval_end)
 
             # download the data for the interval specified and return as df
-            # download_to_dataframe is defined by child class
-            cache_df = self.download_to_dataframe(interval_start, interval_end)
+            cache_df = self.fetch_interval(interval_start, interval_end)
 
             # # save the downloaded data to the sqlite cache
             # self.cache_interval(interval_start, interval_end, cache_df)
@@ -161,43 +337,53 @@ class DataCollector(ABC):
         if cache_df is not None:
             self.cache_interval(interval_start, interval_end, cache_df)
 
-    def create_cache_engine(self):
+    def get_cache_path(self):
         # full path to the cache database
-        cache_path = os.path.abspath(os.path.join(os.path.dirname(__file__),
-                                                  os.path.pardir,
-                                                  'cache',
-                                                  self.cache_name))
+        return os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                            os.path.pardir,
+                                            'cache',
+                                            self.cache_name))
+
+    def cache_interval(self, interval_start, interval_end, cache_df):
+        # intervals can be cached from the download workers while they are
+        # streaming, so only one interval is written at a time
+        with self.cache_lock:
+            # run any pre-cache routiens defined in the child class
+            self.pre_cache_routine(interval_start, interval_end)
 
-        # create sqlite database natural
-        cache = {'drivername': 'sqlite',
-                 'database': cache_path}
+            # write the data and the coverage in a single transaction so that
+            # the coverage can never claim data that was not stored
+            try:
+                with self.storage.begin(interval_start, interval_end) as cn:
 
-        # return databse engine
-        return sqlalchemy.create_engine(URL(**cache), echo=False)
+                    # cache the downloaded data if there is data to cache
+                    if not cache_df.empty:
+                        self.storage.write(cache_df, cn)
 
-    def cache_interval(self, interval_start, interval_end, cache_df):
-        # run any pre-cache routiens defined in the child class
-        self.pre_cache_routine(interval_start, interval_end)
+                    self.update_coverage(interval_start, interval_end, cn)
 
-        # cache the downloaded data if there is data to cache
-        if not cache_df.empty:
-            self.dataframe_to_sql(cache_df)
+            # if the transaction was rolled back, the coverage held in memory
+            # no longer matches the cache and needs to be reloaded
+            except Exception:
+                self.load_coverage()
+                raise
 
-        self.update_coverage(interval_start, interval_end)
+            # results compiled before this interval was cached are out of date
+            for keyword in self.keywords:
+                compile_cache.invalidate(self.cache_path, self.collector_name,
+                                         keyword)
 
-        # run any post-cache routiens defined in the child class
-        self.post_cache_routine(interval_start, interval_end)
+            # run any post-cache routiens defined in the child class
+            self.post_cache_routine(interval_start, interval_end)
 
     def is_cache_complete(self, interval_start, interval_end):
         # test if the interval is contained within the bounds of any of the
         # coverage intervals
-        max_coverage_end = datetime.utcfromtimestamp(0)
-        for coverage_start, coverage_end in self.coverage:
-            max_coverage_end = max(max_coverage_end, coverage_end)
-            if (interval_start >= coverage_start and
-                    interval_end <= coverage_end):
-                return True
+        if self.coverage.covers(interval_start, interval_end):
+            return True
 
+        max_coverage_end = self.coverage.max_end(
+            default=datetime.utcfromtimestamp(0))
         if interval_end > max_coverage_end:
             if datetime.utcnow() - max_coverage_end < self.data_resolution:
                 return True
@@ -205,28 +391,30 @@ class DataCollector(ABC):
         return False
 
     def load_coverage(self):
-        # load the coverage intervals from the sqlite database
-        query = self.session.query(self.coverage_table)
-        query = query.filter((self.coverage_table.keyword == self.keyword),
-                             (self.coverage_table.coverage_interval
-                              == self.coverage_interval))
-        coverage_df = pd.read_sql(sql=query.statement,
-                                  con=self.session.bind)
-
-        # create an empty dataframe if there is no coverage
-        if coverage_df.empty:
-            coverage_df = pd.DataFrame(data=None,
-                                       columns=coverage_df.columns,
-                                       index=coverage_df.index)
-
-        # convert dataframe to nested list for easier handling
-        coverage = coverage_df[['query_start', 'query_end']].values.tolist()
-        for i, interval in enumerate(coverage):
-            for b, bound in enumerate(interval):
-                coverage[i][b] = datetime.utcfromtimestamp(bound * 1e-9)
-
-        # assign coverage as a class attribute
-        self.coverage = coverage
+        # load the coverage intervals from the cache and assign coverage as a
+        # class attribute. the index keeps the intervals sorted and merged so
+        # that they can be searched with bisection
+        self.coverage = CoverageIndex(self.storage.load_coverage(self.keyword))
+
+        # coverage of the other keywords sharing the downloads is loaded the
+        # first time it is needed
+        self.shared_coverage = {}
+
+    def covered_keywords(self):
+        # keywords that a download covers. child classes leave out the
+        # keywords that could not be downloaded
+        return self.keywords
+
+    def keyword_coverage(self, keyword):
+        # return the coverage index of any keyword sharing the downloads
+        if keyword == self.keyword:
+            return self.coverage
+
+        if keyword not in self.shared_coverage:
+            self.shared_coverage[keyword] = CoverageIndex(
+                self.storage.load_coverage(keyword))
+
+        return self.shared_coverage[keyword]
 
     def define_cache_coverage_table(self, Base):
         # create a table to store the coverage intervals
@@ -236,36 +424,20 @@ class DataCollector(ABC):
                     'keyword': Column('keyword', String(32), primary_key=True),
                     'query_start': Column(DateTime, primary_key=True),
                     'coverage_interval': Column(DateTime, primary_key=True),
-                    'query_end': Column(DateTime)}
+                    'query_end': Column(DateTime),
+                    '__table_args__': (
+                        Index('ix_{0}_interval'.format(
+                            self.coverage_table_name),
+                            'keyword', 'coverage_interval', 'query_start'),)}
 
         self.coverage_table = type('Coverage', (Base, ), coverage)
 
     def update_coverage_list(self, interval_start, interval_end):
-        # after the cache is updated, we need to update the coverage intervals
-        merged_coverage = []
-        coverage = self.coverage
-        coverage.append([interval_start, interval_end])
-        coverage = sorted(coverage, key=lambda x: x[0])
-
-        # loop through the coverage intervals and merge any overlapping ones
-        for higher in coverage:
-            # add the first interval to the merged list
-            if not merged_coverage:
-                merged_coverage.append(higher)
-            else:
-                lower = merged_coverage[-1]
-                # test for intersection between lower and higher:
-                # we know via sorting that lower[0] <= higher[0]
-                if higher[0] <= lower[1]:
-                    upper_bound = max(lower[1], higher[1])
-                    # replace by merged interval
-                    merged_coverage[-1] = (lower[0], upper_bound)
-                else:
-                    # add interval to coverage list
-                    merged_coverage.append(higher)
-        self.coverage = [list(x) for x in merged_coverage]
-
-    def update_coverage(self, interval_start, interval_end):
+        # after the cache is updated, we need to update the coverage intervals.
+        # the index merges any overlapping intervals as they are added
+        return self.coverage.add(interval_start, interval_end)
+
+    def update_coverage(self, interval_start, interval_end, connection):
         # merge coverage list with current interval
         time_since_epoch = datetime.utcnow() - self.epoch
         num_intervals = time_since_epoch // self.data_resolution
@@ -273,69 +445,125 @@ class DataCollector(ABC):
         bound = (num_intervals *
                  self.data_resolution) + self.epoch
 
-        self.update_coverage_list(interval_start,
-                                  min(bound, interval_end))
+        covered = self.covered_keywords()
+        if self.keyword in covered:
+            merged, removed = self.update_coverage_list(
+                interval_start, min(bound, interval_end))
+
+            # write the merged interval to the cache
+            self.storage.write_coverage(self.keyword, self.coverage, merged,
+                                        removed, connection)
+
+        # the interval was downloaded for every keyword sharing the download
+        for keyword in covered:
+            if keyword == self.keyword:
+                continue
+
+            coverage = self.keyword_coverage(keyword)
+            merged, removed = coverage.add(interval_start,
+                                           min(bound, interval_end))
+            self.storage.write_coverage(keyword, coverage, merged, removed,
+                                        connection)
+
+    def compile(self, download=True, chunksize=None):
+        # download any intervals missing from the cache. new data invalidates
+        # previously compiled results for the keyword
+        intervals = self.download_data() if download else None
+
+        # return the previously compiled result if nothing has changed
+        key = self.compile_key(download)
+        processed_df = compile_cache.get(key)
+        if processed_df is not None:
+            return processed_df
 
-        # convert coverge list to dataframe
-        coverage_df = pd.DataFrame(self.coverage, columns=['query_start',
-                                                           'query_end'])
-        coverage_df.insert(0, 'keyword', self.keyword)
-        coverage_df.insert(2, 'coverage_interval', self.coverage_interval)
+        if download:
+            read_start, read_end = self.read_bounds(intervals)
+        else:
+            read_start, read_end = self.start_date, self.end_date
 
-        # remove coverage intervals from sqlite database
-        query = self.session.query(self.coverage_table)
-        query = query.filter((self.coverage_table.keyword == self.keyword))
-        query.delete(synchronize_session=False)
-        self.session.commit()
+        # run any pre-compile routines defined in the child class
+        self.pre_compile_routine(read_start, read_end)
 
-        # add new coverage intervals to sqlite database
-        coverage_df.to_sql(self.coverage_table_name, self.cache_engine,
-                           if_exists='append', index=False)
+        # collectors that keep the processed data aggregated in the cache
+        # return it directly
+        processed_df = self.read_processed(read_start, read_end)
 
-    def compile(self, download=True):
-        if download:
-            data_df = self.query_data()
-        else:
-            data_df = self.sql_to_dataframe(self.start_date, self.end_date)
+        if processed_df is None and chunksize:
+
+            # stream the cache through the processing in time ordered chunks
+            # so that the raw data never has to be held in memory at once
+            chunks = self.storage.read_chunks(read_start, read_end, chunksize)
+            processed_df = self.process_raw_chunks(chunks)
+
+        elif processed_df is None:
+            if download:
+                self.status('LOADING FROM CACHE', self.start_date,
+                            self.end_date)
+                data_df = self.storage.read(read_start, read_end)
+                self.next_status()
+            else:
+                data_df = self.storage.read(read_start, read_end)
+
+            processed_df = self.process_raw_data(data_df)
 
-        processed_df = self.process_raw_data(data_df)
         if isinstance(processed_df.index, pd.DatetimeIndex):
-            return processed_df[self.start_date:self.end_date]
-        else:
-            return processed_df
+            processed_df = processed_df[self.start_date:self.end_date]
 
-    def merge_dataframe_into_table(self, dataframe, table_name, p_keys):
-        temp_table_name = 'temp'
+        compile_cache.put(key, processed_df)
 
-        dataframe.to_sql(temp_table_name, self.cache_engine,
-                         if_exists='replace', index=False)
+        return processed_df
 
-        insert_string = dataframe.columns[0]
-        select_string = 't.{0}'.format(dataframe.columns[0])
+    def read_processed(self, interval_start, interval_end):
+        # return the processed data for the interval if the collector keeps
+        # it pre-aggregated in the cache, or None to process the raw data
+        return None
 
-        for column_name in dataframe.columns[1:]:
-            insert_string = '{0}, {1}'.format(insert_string, column_name)
-            select_string = '{0}, t.{1}'.format(select_string, column_name)
+    def compile_key(self, download):
+        # identifies a compiled result. the first three entries are used to
+        # invalidate results when new data is cached for the keyword
+        return (self.cache_path, self.collector_name, self.keyword,
+                type(self).__name__, type(self.storage).__name__,
+                self.coverage_interval, self.start_date, self.end_date,
+                self.sample_interval, self.data_resolution, download,
+                self.compile_options())
 
-        where_string = 't.{0} = f.{0}'.format(p_keys[0])
-        for key_name in p_keys[1:]:
-            where_string = '{0} AND t.{1} = f.{1}'.format(where_string,
-                                                          key_name)
-        with self.cache_engine.begin() as cn:
-            sql = """INSERT INTO "{final_table}" ({insert_string})
-                     SELECT {select_string}
-                     FROM "{temp_table}" t
-                     WHERE NOT EXISTS
-                        (SELECT 1 FROM "{final_table}" f
-                        WHERE {where_string})""".format(
-                            final_table=table_name,
-                            temp_table=temp_table_name,
-                            insert_string=insert_string,
-                            select_string=select_string,
-                            where_string=where_string)
-            cn.execute(sql)
-            cn.execute('DROP TABLE IF EXISTS {temp}'.format(
-                temp=temp_table_name))
+    def compile_options(self):
+        # options of the child class that change the compiled result
+        return ()
+
+    def pre_compile_routine(self, interval_start, interval_end):
+        # by default the cached data is compiled as it is
+        pass
+
+    def sql_to_chunks(self, interval_start, interval_end, chunksize):
+        # collectors that cannot read their cache in chunks load it at once
+        yield self.sql_to_dataframe(interval_start, interval_end)
+
+    def process_raw_chunks(self, chunks):
+        # by default the chunks are combined and processed together. child
+        # classes that can process chunks incrementally override this
+        return self.process_raw_data(pd.concat(list(chunks)))
+
+    def upsert_dataframe(self, dataframe, table, connection=None):
+        # insert the rows of the dataframe into the table, skipping any rows
+        # whose primary key is already in the cache. the rows are written in
+        # batches with executemany inside a single transaction
+        if dataframe.empty:
+            return
+
+        # open a transaction if the caller has not provided one
+        if connection is None:
+            with self.cache_engine.begin() as connection:
+                return self.upsert_dataframe(dataframe, table, connection)
+
+        if not isinstance(table, sqlalchemy.Table):
+            table = table.__table__
+
+        insert = table.insert().prefix_with('OR IGNORE')
+        records = dataframe.to_dict('records')
+
+        for i in range(0, len(records), self.upsert_chunk_size):
+            connection.execute(insert, records[i:i + self.upsert_chunk_size])
 
     @abstractmethod
     def define_cache_table(self, Base):
@@ -350,7 +578,7 @@ class DataCollector(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    def dataframe_to_sql(self, cache_df):
+    def dataframe_to_sql(self, cache_df, connection):
         raise NotImplementedError
 
     @abstractmethod
@@ -379,14 +607,43 @@ class DataCollector(ABC):
 
 
 class SequentialDataCollector(DataCollector):
-    def __init__(self, **kwargs):
+
+    # columns identifying a downloaded row when the density of the data is
+    # measured, so that a row tagged with several keywords or cached twice
+    # by a resumed download is counted once. every row is counted if this
+    # is None
+    density_keys = None
+
+    def __init__(self, target_rows=None, min_interval=None, max_interval=None,
+                 **kwargs):
 
         self.coverage_interval = datetime.utcfromtimestamp(0)
 
         # pass all the parameters to the Data Collector Class
         super().__init__(**kwargs)
 
+        # number of rows to aim for in each request. the intervals are sized
+        # from the density of the data when this is set, between the minimum
+        # and maximum interval sizes
+        self.target_rows = target_rows
+        self.min_interval = pd.to_timedelta(min_interval or
+                                            self.data_resolution)
+        self.max_interval = pd.to_timedelta(max_interval or
+                                            10 * self.sample_interval)
+
+        # rows per second in the most recently downloaded interval and the
+        # end of that interval
+        self.observed_density = None
+        self.observed_end = None
+
+        # rows cached by the download running on each thread while it is
+        # streaming
+        self.streamed = threading.local()
+
     def download_intervals(self):
+        if self.target_rows:
+            return self.plan_intervals()
+
         # determine the number of intervals based on the interval size
         num_intervals = ((self.end_date - self.start_date) //
                          self.sample_interval) + 1
@@ -406,27 +663,11 @@ class SequentialDataCollector(DataCollector):
             if upper_bound > datetime.utcnow():
                 upper_bound = datetime.utcnow()
 
-            # define interval
-            interval = [lower_bound, upper_bound]
-
-            # compare interval against each coverage interval
-            for j, coverage in enumerate(self.coverage):
-
-                # test amount of overalp between the coverage and the interval
-                overlap = max(timedelta(0), min(interval[1], coverage[1]) -
-                              max(interval[0], coverage[0]))
-
-                # adjust the interval if it straddles a coverage boundary. Note
-                # that in the case where the coverage is entirely within the
-                # interval, the whole interval will be flagged to eb downloaded
-                # again.
-                if overlap > timedelta(0):
-                    if (interval[0] < coverage[1] and
-                            interval[1] > coverage[1]):
-                        interval[0] = coverage[1]
-                    if (interval[1] > coverage[0] and
-                            interval[0] < coverage[0]):
-                        interval[1] = coverage[0]
+            # adjust the interval if it straddles a coverage boundary. Note
+            # that in the case where the coverage is entirely within the
+            # interval, the whole interval will be flagged to eb downloaded
+            # again.
+            interval = self.coverage.clip(lower_bound, upper_bound)
 
             # add new_interval to list
             intervals.append(interval)
@@ -434,17 +675,283 @@ class SequentialDataCollector(DataCollector):
         # return list of intervals
         return intervals
 
+    def plan_intervals(self):
+        # split the gaps in the coverage into intervals of around target_rows
+        # rows each. the plan is generated lazily so that, when downloading
+        # sequentially, each interval is sized from the data before it. the
+        # plan runs to the end of the bucket holding the end date
+        num_intervals = (self.end_date - self.epoch) // self.data_resolution
+        plan_end = min(self.epoch + (num_intervals + 1) * self.data_resolution,
+                       datetime.utcnow())
+
+        interval_size = None
+        for gap_start, gap_end in self.coverage.gaps(self.start_date,
+                                                     plan_end):
+            interval_start = gap_start
+            while interval_start < gap_end:
+                interval_end = min(self.next_interval_end(interval_start,
+                                                          interval_size),
+                                   gap_end)
+                yield [interval_start, interval_end]
+
+                interval_size = interval_end - interval_start
+                interval_start = interval_end
+
+    def next_interval_end(self, interval_start, previous_size=None):
+        # size the interval from the estimated density of the data, falling
+        # back to the sample interval when nothing is known yet
+        density = self.estimate_density(interval_start)
+        if density is None:
+            interval_size = self.sample_interval
+        elif density > 0:
+            interval_size = pd.Timedelta(seconds=self.target_rows / density)
+        else:
+            interval_size = self.max_interval
+
+        # intervals shrink as soon as the data gets denser but only grow
+        # gradually, since a quiet period can be followed by a busy one
+        if previous_size is not None:
+            interval_size = min(interval_size, 2 * previous_size)
+
+        interval_size = min(max(interval_size, self.min_interval),
+                            self.max_interval)
+
+        # round the end up to the data resolution so that the coverage
+        # bounds line up with the buckets of the processed data
+        num_intervals = -(-(interval_start + interval_size - self.epoch) //
+                          self.data_resolution)
+        return self.epoch + num_intervals * self.data_resolution
+
+    def estimate_density(self, interval_start):
+        # rows per second expected after the interval start. the response
+        # that ended at the interval start is the best guide, then the data
+        # cached before it, then the last response
+        if self.observed_end == interval_start:
+            return self.observed_density
+
+        density = self.cached_density(interval_start)
+        if density is None:
+            density = self.observed_density
+
+        return density
+
+    def cached_density(self, interval_start):
+        # child classes that can count their cached data cheaply override
+        # this to return the rows per second before the interval start
+        return None
+
+    def fetch_interval(self, interval_start, interval_end):
+        self.streamed.rows = []
+        try:
+            data_df = super().fetch_interval(interval_start, interval_end)
+            rows = self.streamed.rows + [self.density_rows(data_df)]
+        finally:
+            self.streamed.rows = None
+
+        # the density of each download, including the chunks it cached while
+        # streaming, is used to size the next interval
+        duration = (interval_end - interval_start).total_seconds()
+        if duration > 0:
+            if self.density_keys is None:
+                num_rows = sum(map(len, rows))
+            else:
+                num_rows = len(pd.concat(rows).drop_duplicates())
+
+            self.observed_density = num_rows / duration
+            self.observed_end = interval_end
+
+        return data_df
+
+    def cache_interval(self, interval_start, interval_end, cache_df):
+        super().cache_interval(interval_start, interval_end, cache_df)
+
+        # chunks cached while a download is streaming are counted with the
+        # rows it returns
+        if getattr(self.streamed, 'rows', None) is not None:
+            self.streamed.rows.append(self.density_rows(cache_df))
+
+    def density_rows(self, data_df):
+        # the columns identifying the rows of the data, or the data itself
+        # if every row is counted
+        if self.density_keys is None or data_df.empty:
+            return data_df
+
+        return data_df[self.density_keys]
+
 
 class CommentCollector(SequentialDataCollector):
+
+    # columns used to order and deduplicate the data in columnar storage
+    time_column = 'timestamp'
+    storage_keys = ['keyword', 'id']
+
+    # comments are downloaded once for all the keywords they mention
+    shares_keywords = True
+    density_keys = ['id']
+
+    # authors and communities repeat across many comments
+    column_dtypes = {'keyword': 'category',
+                     'author': 'category',
+                     'timestamp': 'datetime64[ns]'}
+
+    # number of comments counted at a time when the rollup is rebuilt
+    rollup_chunk_size = 100000
+
+    # number of comments per sentiment scoring task and the number of
+    # processes scoring them, which defaults to the number of cpus
+    sentiment_batch_size = 1000
+    sentiment_workers = None
+
     def __init__(self, sample_interval='31d', data_resolution='1h',
-                 community_title='community', **kwargs):
+                 community_title='community', mention_keywords=None,
+                 sentiment=False, **kwargs):
 
         self.community_title = community_title
+        self.column_dtypes = dict(self.column_dtypes,
+                                  **{community_title: 'category'})
+
+        # whether the mean sentiment of the comments is compiled alongside
+        # the mentions
+        self.sentiment = sentiment
+
+        # additional keywords whose mentions are counted alongside the
+        # collector keyword, such as the other coins on a watchlist
+        self.mention_keywords = [keyword.lower() for keyword in
+                                 (mention_keywords or [])]
 
         # call the init functions of the parent class
         super().__init__(sample_interval=sample_interval,
                          data_resolution=data_resolution, **kwargs)
 
+        # sentiment scores are stored in the sqlite cache
+        if self.sentiment and not isinstance(self.storage, SQLiteStorage):
+            raise RuntimeError('sentiment requires the sqlite cache')
+
+        # full text index over the cached comments
+        self.create_text_index()
+
+        # mentions of the keywords aggregated into buckets of the data
+        # resolution, stored alongside the comments
+        self.rollup_interval = pd.Timestamp(
+            self.epoch + self.data_resolution).to_pydatetime()
+        self.create_rollup()
+
+    def create_text_index(self):
+        # the index is an fts5 table holding the text of every comment under
+        # the rowid of the comment, so that the triggers keeping it in sync
+        # with the comments table look rows up by rowid. comments skipped by
+        # INSERT OR IGNORE are not indexed twice
+        self.text_index_name = '{0}-fts'.format(self.comment_table_name)
+
+        statements = [
+            'CREATE VIRTUAL TABLE "{fts}" USING fts5(text)',
+            'CREATE TRIGGER IF NOT EXISTS "{fts}-insert" AFTER INSERT ON '
+            '"{comments}" BEGIN INSERT INTO "{fts}" (rowid, text) '
+            'VALUES (new.rowid, new.text); END',
+            'CREATE TRIGGER IF NOT EXISTS "{fts}-delete" AFTER DELETE ON '
+            '"{comments}" BEGIN DELETE FROM "{fts}" WHERE rowid = old.rowid; '
+            'END',
+            'CREATE TRIGGER IF NOT EXISTS "{fts}-update" AFTER UPDATE OF '
+            'text ON "{comments}" BEGIN UPDATE "{fts}" SET text = new.text '
+            'WHERE rowid = old.rowid; END']
+
+        with self.cache_engine.begin() as cn:
+            trigger = cn.execute(
+                sqlalchemy.text('SELECT sql FROM sqlite_master '
+                                'WHERE name = :n'),
+                n='{0}-delete'.format(self.text_index_name)).scalar()
+            if trigger is not None and 'old.rowid' in trigger:
+                return
+
+            # indexes keyed by the comment id are rebuilt
+            for name in ['insert', 'delete', 'update']:
+                cn.execute('DROP TRIGGER IF EXISTS "{fts}-{name}"'.format(
+                    fts=self.text_index_name, name=name))
+            cn.execute('DROP TABLE IF EXISTS "{fts}"'.format(
+                fts=self.text_index_name))
+
+            try:
+                cn.execute(statements[0].format(
+                    fts=self.text_index_name))
+
+            # sqlite may have been built without fts5
+            except sqlalchemy.exc.OperationalError:
+                self.text_index_name = None
+                return
+
+            for statement in statements[1:]:
+                cn.execute(statement.format(fts=self.text_index_name,
+                                            comments=self.comment_table_name))
+
+            # index comments cached before the index existed
+            cn.execute('INSERT INTO "{fts}" (rowid, text) SELECT rowid, text '
+                       'FROM "{comments}"'.format(
+                           fts=self.text_index_name,
+                           comments=self.comment_table_name))
+
+    def search_comments(self, query, interval_start=None, interval_end=None):
+        # return the cached comments matching an fts5 query, such as
+        # 'bitcoin OR btc' or 'moon NEAR(lambo)'
+        sql = ('SELECT c.* FROM "{fts}" f JOIN "{comments}" c '
+               'ON c.rowid = f.rowid WHERE f.text MATCH :query{interval} '
+               'ORDER BY c.timestamp')
+
+        comments_df = self.text_index_query(sql, query, interval_start,
+                                            interval_end)
+        comments_df['timestamp'] = pd.to_datetime(comments_df['timestamp'])
+
+        return comments_df
+
+    def count_matches(self, keyword, interval_start=None, interval_end=None):
+        # count the mentions of a keyword in the cached comments from the
+        # full text index. only comments containing the keyword as a word
+        # are counted, unlike the substring count used by process_raw_data
+        resolution = int(self.data_resolution.total_seconds())
+        sql = ('SELECT CAST(strftime(\'%s\', c.timestamp) AS INTEGER) / '
+               '{resolution} AS bucket, COUNT(*) AS comments, '
+               'SUM((length(lower(c.text)) - length(replace(lower(c.text), '
+               'lower(:keyword), \'\'))) / length(:keyword)) AS mentions '
+               'FROM "{fts}" f JOIN "{comments}" c ON c.rowid = f.rowid '
+               'WHERE f.text MATCH :query{interval} GROUP BY bucket')
+
+        # keywords are matched as a phrase
+        query = '"{0}"'.format(keyword.replace('"', '""'))
+        counts_df = self.text_index_query(
+            sql.replace('{resolution}', str(resolution)), query,
+            interval_start, interval_end, keyword=keyword)
+
+        counts_df['data_start'] = pd.to_datetime(
+            counts_df.pop('bucket') * resolution, unit='s')
+        counts_df = counts_df.set_index('data_start')
+
+        return counts_df.resample(self.data_resolution).sum()
+
+    def text_index_query(self, sql, query, interval_start, interval_end,
+                         **params):
+        if not self.text_index_name:
+            raise RuntimeError('sqlite was built without fts5')
+
+        # restrict the matches to an interval if one is given. the bounds
+        # are bound as datetimes so they compare like the cached timestamps
+        interval = ''
+        bounds = []
+        if interval_start is not None:
+            interval += ' AND c.timestamp >= :interval_start'
+            bounds.append(sqlalchemy.bindparam(
+                'interval_start', interval_start, type_=DateTime))
+        if interval_end is not None:
+            interval += ' AND c.timestamp <= :interval_end'
+            bounds.append(sqlalchemy.bindparam(
+                'interval_end', interval_end, type_=DateTime))
+
+        sql = sqlalchemy.text(sql.format(fts=self.text_index_name,
+                                         comments=self.comment_table_name,
+                                         interval=interval))
+        sql = sql.bindparams(*bounds)
+
+        return pd.read_sql(sql, con=self.cache_engine,
+                           params=dict(params, query=query))
+
     def define_cache_table(self, Base):
 
         # create a table to store the data that is downloaded
@@ -455,7 +962,10 @@ class CommentCollector(SequentialDataCollector):
                     self.community_title: Column(String(32)),
                     'author': Column(String(32)),
                     'timestamp': Column(DateTime),
-                    'text': Column(Text)}
+                    'text': Column(Text),
+                    '__table_args__': (
+                        Index('ix_{0}_timestamp'.format(
+                            self.comment_table_name), 'timestamp', 'id'),)}
 
         self.comment_table = type('Comments', (Base, ), comments)
 
@@ -469,17 +979,50 @@ class CommentCollector(SequentialDataCollector):
 
         self.cache_table = type('Cache', (Base, ), cache)
 
-    def dataframe_to_sql(self, cache_df):
+        # create a table to store the mentions of each keyword aggregated
+        # into buckets, so that compiling does not need the raw comments
+        self.rollup_table_name = '{0}-rollup'.format(self.collector_name)
+
+        rollup = {'__tablename__': self.rollup_table_name,
+                  'keyword': Column(String(32), primary_key=True),
+                  'bucket_interval': Column(DateTime, primary_key=True),
+                  'bucket_start': Column(DateTime, primary_key=True),
+                  'mentions': Column(Integer),
+                  'comment_count': Column(Integer),
+                  'sentiment_sum': Column(Float),
+                  'sentiment_count': Column(Integer)}
+
+        self.rollup_table = type('Rollup', (Base, ), rollup)
+
+        # create a table to store the sentiment score of each comment
+        self.sentiment_table_name = '{0}-sentiment'.format(
+            self.collector_name)
+
+        sentiment = {'__tablename__': self.sentiment_table_name,
+                     'comment_id': Column(String(32),
+                                          ForeignKey(self.comment_table.id),
+                                          primary_key=True),
+                     'sentiment': Column(Float)}
+
+        self.sentiment_table = type('Sentiment', (Base, ), sentiment)
+
+    def dataframe_to_sql(self, cache_df, connection):
         cache = cache_df[['keyword', 'id']]
         cache = cache.rename(columns={'id': 'comment_id'})
 
         comments = cache_df[['id', self.community_title, 'author', 'timestamp',
                              'text']]
 
-        self.merge_dataframe_into_table(cache, self.collector_name,
-                                        ['comment_id', 'keyword'])
-        self.merge_dataframe_into_table(comments, self.comment_table_name,
-                                        ['id'])
+        self.upsert_dataframe(comments, self.comment_table, connection)
+        self.upsert_dataframe(cache, self.cache_table, connection)
+
+        # recount the rollup buckets that the new comments fall into
+        bucket_intervals = self.rollup_intervals(connection)
+        for keyword, keyword_df in cache_df.groupby('keyword', observed=True):
+            for bucket_interval in bucket_intervals:
+                self.recount_rollup(keyword, bucket_interval, connection,
+                                    keyword_df['timestamp'].min(),
+                                    keyword_df['timestamp'].max())
 
     def sql_to_dataframe(self, interval_start, interval_end):
         # load data from cache
@@ -490,11 +1033,25 @@ class CommentCollector(SequentialDataCollector):
         # return cached data as dataframe
         return cache_df
 
+    def sql_to_chunks(self, interval_start, interval_end, chunksize):
+        # stream data from the cache in time ordered chunks
+        query = self.interval_sql_query(interval_start, interval_end)
+        query = query.order_by('timestamp')
+        return pd.read_sql(sql=query.statement, con=self.session.bind,
+                           chunksize=chunksize)
+
     def interval_sql_query(self, interval_start, interval_end):
         # generate the sql query for retrieving cached data
         query = self.session.query(self.cache_table, self.comment_table)
-        query = query.outerjoin(self.comment_table, self.comment_table.id ==
-                                self.cache_table.comment_id)
+        query = query.join(self.comment_table, self.comment_table.id ==
+                           self.cache_table.comment_id)
+
+        # include the sentiment scores of the comments that have them
+        if self.sentiment:
+            query = query.add_columns(self.sentiment_table.sentiment)
+            query = query.outerjoin(
+                self.sentiment_table, self.sentiment_table.comment_id ==
+                self.comment_table.id)
         query = query.filter(
             self.cache_table.keyword == self.keyword,
             self.comment_table.timestamp >= interval_start,
@@ -503,6 +1060,162 @@ class CommentCollector(SequentialDataCollector):
         # return the cache query
         return query
 
+    def create_rollup(self):
+        # the rollup is only kept in the sqlite cache
+        if not isinstance(self.storage, SQLiteStorage):
+            return
+
+        rollup = self.rollup_table.__table__
+        cache = self.cache_table.__table__
+
+        # build the rollup for comments cached before the rollup existed, or
+        # before this bucket size was used. from then on it is updated as
+        # each interval is cached
+        with self.cache_engine.begin() as cn:
+            built = cn.execute(sqlalchemy.select([rollup.c.keyword]).where(
+                rollup.c.bucket_interval == self.rollup_interval).limit(
+                    1)).first()
+            if built:
+                return
+
+            keywords = [row[0] for row in cn.execute(
+                sqlalchemy.select([cache.c.keyword]).distinct())]
+            for keyword in keywords:
+                self.recount_rollup(keyword, self.rollup_interval, cn)
+
+    def rollup_intervals(self, connection):
+        # bucket sizes held in the rollup. every size is kept up to date so
+        # that collectors with different resolutions can share the cache
+        rollup = self.rollup_table.__table__
+        query = sqlalchemy.select([rollup.c.bucket_interval]).distinct()
+
+        bucket_intervals = {row[0] for row in connection.execute(query)}
+        bucket_intervals.add(self.rollup_interval)
+
+        return sorted(bucket_intervals)
+
+    def bucket_floor(self, timestamp, resolution):
+        # start of the bucket holding the timestamp. buckets are aligned to
+        # the epoch like the query intervals
+        return self.epoch + ((timestamp - self.epoch) // resolution) * \
+            resolution
+
+    def recount_rollup(self, keyword, bucket_interval, connection,
+                       interval_start=None, interval_end=None):
+        # recount the rollup buckets of a keyword from the cached comments,
+        # either the buckets touching an interval or the whole cache
+        comments = self.comment_table.__table__
+        cache = self.cache_table.__table__
+        rollup = self.rollup_table.__table__
+        scores = self.sentiment_table.__table__
+        resolution = pd.Timedelta(bucket_interval - self.epoch)
+
+        source = sqlalchemy.select(
+            [comments.c.timestamp, comments.c.text,
+             scores.c.sentiment]).select_from(
+                comments.join(cache, cache.c.comment_id == comments.c.id)
+                .outerjoin(scores, scores.c.comment_id == comments.c.id))
+        source = source.where(cache.c.keyword == keyword)
+        buckets = sqlalchemy.and_(rollup.c.keyword == keyword,
+                                  rollup.c.bucket_interval == bucket_interval)
+
+        if interval_start is not None:
+            lower = self.bucket_floor(interval_start, resolution)
+            upper = self.bucket_floor(interval_end, resolution) + resolution
+            source = source.where(sqlalchemy.and_(
+                comments.c.timestamp >= lower, comments.c.timestamp < upper))
+            buckets = sqlalchemy.and_(buckets, rollup.c.bucket_start >= lower,
+                                      rollup.c.bucket_start < upper)
+
+        # a chunk boundary can split a bucket so the partial counts of the
+        # chunks are summed together
+        counts = []
+        for chunk_df in pd.read_sql(source, con=connection,
+                                    chunksize=self.rollup_chunk_size):
+            mentions = count_mentions(chunk_df['text'], [keyword])
+            scored = chunk_df['sentiment'].notna()
+            counts.append(pd.DataFrame({
+                'bucket_start': self.bucket_floor(
+                    pd.to_datetime(chunk_df['timestamp']), resolution),
+                'mentions': mentions[keyword].values,
+                'comment_count': 1,
+                'sentiment_sum': chunk_df['sentiment'].fillna(0).values,
+                'sentiment_count': scored.astype(int).values}))
+
+        connection.execute(rollup.delete().where(buckets))
+        if not counts:
+            return
+
+        rollup_df = pd.concat(counts).groupby('bucket_start',
+                                              as_index=False).sum()
+        rollup_df.insert(0, 'keyword', keyword)
+        rollup_df.insert(1, 'bucket_interval', bucket_interval)
+
+        self.upsert_dataframe(rollup_df, rollup, connection)
+
+    def cached_density(self, interval_start):
+        # comments per second in the covered part of the sample interval
+        # before the interval start, counted from the rollup
+        if not isinstance(self.storage, SQLiteStorage):
+            return None
+
+        window_start = interval_start - self.sample_interval
+        covered = self.sample_interval
+        for gap_start, gap_end in self.coverage.gaps(window_start,
+                                                     interval_start):
+            covered -= gap_end - gap_start
+
+        if covered < self.data_resolution:
+            return None
+
+        rollup = self.rollup_table.__table__
+        query = sqlalchemy.select(
+            [sqlalchemy.func.sum(rollup.c.comment_count)]).where(
+                sqlalchemy.and_(
+                    rollup.c.keyword == self.keyword,
+                    rollup.c.bucket_interval == self.rollup_interval,
+                    rollup.c.bucket_start >= window_start,
+                    rollup.c.bucket_start < interval_start))
+
+        with self.cache_engine.connect() as cn:
+            comment_count = cn.execute(query).scalar() or 0
+
+        return comment_count / covered.total_seconds()
+
+    def read_processed(self, interval_start, interval_end):
+        # the rollup only holds the mentions of each keyword in its own
+        # comments, so counting other keywords needs the raw comments
+        if (not isinstance(self.storage, SQLiteStorage) or
+                len(self.counted_keywords()) > 1):
+            return None
+
+        rollup = self.rollup_table.__table__
+        columns = [rollup.c.bucket_start, rollup.c.mentions]
+        if self.sentiment:
+            columns += [rollup.c.sentiment_sum, rollup.c.sentiment_count]
+
+        query = sqlalchemy.select(columns).where(sqlalchemy.and_(
+                rollup.c.keyword == self.keyword,
+                rollup.c.bucket_interval == self.rollup_interval,
+                rollup.c.bucket_start >= self.bucket_floor(
+                    interval_start, self.data_resolution),
+                rollup.c.bucket_start <= interval_end))
+        query = query.order_by(rollup.c.bucket_start)
+
+        rollup_df = pd.read_sql(query, con=self.cache_engine)
+        rollup_df['bucket_start'] = pd.to_datetime(rollup_df['bucket_start'])
+        rollup_df = rollup_df.set_index('bucket_start')
+
+        # buckets without comments are not stored
+        if rollup_df.empty:
+            index = pd.DatetimeIndex([], name='data_start')
+        else:
+            index = pd.date_range(rollup_df.index[0], rollup_df.index[-1],
+                                  freq=self.data_resolution,
+                                  name='data_start')
+
+        return self.average_sentiment(rollup_df.reindex(index, fill_value=0))
+
     def pre_cache_routine(self, interval_start, interval_end):
         pass
 
@@ -510,19 +1223,217 @@ class CommentCollector(SequentialDataCollector):
         pass
 
     def process_raw_data(self, data_df):
-        data_df['mentions'] = data_df['text'].apply(
-            self.count_keyword_mentions)
-        # data_df['sentiment'] = data_df['text'].apply(self.analyze_sentiment)
-
-        data_df = data_df.set_index('timestamp')
+        return self.average_sentiment(self.count_raw_data(data_df))
+
+    def count_raw_data(self, data_df):
+        # count the mentions of every keyword in a single pass over the text
+        keywords = self.counted_keywords()
+        counts_df = count_mentions(data_df['text'], keywords)
+        counts_df.columns = self.mention_columns(keywords)
+
+        # sentiment is summed so that the counts can be combined before the
+        # mean is taken
+        if self.sentiment:
+            counts_df['sentiment_sum'] = data_df['sentiment'].fillna(0).values
+            counts_df['sentiment_count'] = data_df['sentiment'].notna().astype(
+                int).values
+
+        counts_df.index = data_df['timestamp']
+        counts_df = counts_df.resample(self.data_resolution).sum()
+        counts_df.index.names = ['data_start']  # TODO: check to see if shifted
+
+        return counts_df
+
+    def average_sentiment(self, counts_df):
+        # mean sentiment of the scored comments in each bucket. buckets
+        # without scored comments have no sentiment
+        if self.sentiment:
+            counts_df = counts_df.copy()
+            sentiment_count = counts_df.pop('sentiment_count')
+            counts_df['sentiment'] = (counts_df.pop('sentiment_sum') /
+                                      sentiment_count.where(
+                                          sentiment_count > 0))
+
+        return counts_df
+
+    def reindex_cached_comments(self):
+        # link the comments already in the cache that mention the keyword,
+        # so that a new keyword does not need to be downloaded again where
+        # the cached searches were broad enough to catch its mentions
+        if not isinstance(self.storage, SQLiteStorage):
+            raise RuntimeError('re-indexing requires the sqlite cache')
+
+        comments = self.comment_table.__table__
+        cache = self.cache_table.__table__
+        coverage = self.coverage_table.__table__
+
+        # a search for another keyword only caught every mention of the new
+        # keyword if the other keyword is contained in it, as a search for
+        # eth catches the comments mentioning ethereum but not the reverse.
+        # only the coverage of those keywords is held for the new keyword.
+        # keywords downloaded together are already covered for each other
+        keyword = self.keyword.lower()
+        query = sqlalchemy.select([coverage.c.keyword]).distinct().where(
+            sqlalchemy.and_(
+                coverage.c.coverage_interval == self.coverage_interval,
+                coverage.c.keyword != keyword))
+
+        with self.cache_engine.connect() as cn:
+            keywords = [row[0] for row in cn.execute(query)
+                        if row[0] in keyword]
+
+        held = CoverageIndex()
+        for other_keyword in keywords:
+            for interval_start, interval_end in self.storage.load_coverage(
+                    other_keyword):
+                held.add(interval_start, interval_end)
+
+        # sqlite lower only folds ascii characters
+        mentions = sqlalchemy.func.instr(
+            sqlalchemy.func.lower(comments.c.text), keyword) > 0
+        select = sqlalchemy.select(
+            [sqlalchemy.literal(keyword), comments.c.id]).where(mentions)
+        insert = cache.insert().prefix_with('OR IGNORE').from_select(
+            ['keyword', 'comment_id'], select)
+
+        # link the comments and cover the held intervals in one transaction
+        try:
+            with self.cache_engine.begin() as cn:
+                linked = cn.execute(insert).rowcount
+
+                for bucket_interval in self.rollup_intervals(cn):
+                    self.recount_rollup(keyword, bucket_interval, cn)
+
+                for interval_start, interval_end in held:
+                    merged, removed = self.coverage.add(interval_start,
+                                                        interval_end)
+                    self.storage.write_coverage(self.keyword, self.coverage,
+                                                merged, removed, cn)
+
+        except Exception:
+            self.load_coverage()
+            raise
+
+        compile_cache.invalidate(self.cache_path, self.collector_name,
+                                 self.keyword)
+
+        # return the number of comments newly linked to the keyword
+        return linked
+
+    def tag_keywords(self, comments_df):
+        # link each downloaded comment to the keywords it mentions. a
+        # collector with a single keyword links every comment it downloaded
+        if len(self.keywords) == 1:
+            comments_df.insert(0, 'keyword', self.keyword)
+            return comments_df
+
+        # the comments from a combined query are only linked to the
+        # keywords they actually mention
+        mentions_df = count_mentions(comments_df['text'], self.keywords)
+
+        tagged = []
+        for keyword in self.keywords:
+            keyword_df = comments_df[mentions_df[keyword].values > 0].copy()
+            keyword_df.insert(0, 'keyword', keyword)
+            tagged.append(keyword_df)
+
+        return pd.concat(tagged, ignore_index=True)
+
+    def counted_keywords(self):
+        # the collector keyword followed by any additional keywords
+        return [self.keyword] + [keyword for keyword in self.mention_keywords
+                                 if keyword != self.keyword]
+
+    def mention_columns(self, keywords):
+        # the collector keyword keeps the plain mentions column
+        return ['mentions' if keyword == self.keyword else
+                'mentions_{0}'.format(keyword) for keyword in keywords]
+
+    def process_raw_chunks(self, chunks):
+        # process each chunk on its own. a chunk boundary can split a bucket
+        # so the partial buckets are summed when the results are combined
+        processed = [self.count_raw_data(chunk) for chunk in chunks
+                     if not chunk.empty]
+
+        if not processed:
+            index = pd.DatetimeIndex([], name='data_start')
+            columns = self.mention_columns(self.counted_keywords())
+            if self.sentiment:
+                columns.append('sentiment')
+            return pd.DataFrame(columns=columns, index=index)
+
+        data_df = pd.concat(processed)
         data_df = data_df.resample(self.data_resolution).sum()
-        data_df.index.names = ['data_start']  # TODO: check to see if shifted
-        data_df = data_df[['mentions']]
+        data_df.index.names = ['data_start']
+
+        return self.average_sentiment(data_df)
+
+    def compile_options(self):
+        # the additional keywords and sentiment add columns to the result
+        return tuple(self.mention_keywords), self.sentiment
+
+    def pre_compile_routine(self, interval_start, interval_end):
+        # score the comments that were cached since the last compile
+        if self.sentiment:
+            self.score_comments(interval_start, interval_end)
+
+    def score_comments(self, interval_start, interval_end):
+        # score the sentiment of the comments in the interval that have not
+        # been scored yet. each comment is only ever scored once
+        comments = self.comment_table.__table__
+        cache = self.cache_table.__table__
+        scores = self.sentiment_table.__table__
+
+        # whole buckets are scored so that the rollup is complete
+        lower = self.bucket_floor(interval_start, self.data_resolution)
+        upper = self.bucket_floor(interval_end, self.data_resolution) + \
+            self.data_resolution
+
+        query = sqlalchemy.select(
+            [comments.c.id, comments.c.timestamp, comments.c.text]
+        ).select_from(
+            comments.join(cache, cache.c.comment_id == comments.c.id)
+            .outerjoin(scores, scores.c.comment_id == comments.c.id)
+        ).where(sqlalchemy.and_(
+            cache.c.keyword == self.keyword,
+            comments.c.timestamp >= lower,
+            comments.c.timestamp < upper,
+            scores.c.comment_id.is_(None)))
+
+        unscored_df = pd.read_sql(query, con=self.cache_engine)
+        if unscored_df.empty:
+            return
 
-        return data_df
+        self.status('SCORING SENTIMENT', interval_start, interval_end)
+
+        scores_df = pd.DataFrame({
+            'comment_id': unscored_df['id'],
+            'sentiment': score_sentiment(
+                unscored_df['text'].fillna('').tolist(),
+                max_workers=self.sentiment_workers,
+                batch_size=self.sentiment_batch_size)})
+
+        timestamps = pd.to_datetime(unscored_df['timestamp'])
+        first, last = timestamps.min(), timestamps.max()
+
+        # the scores are shared by every keyword linked to the comments, so
+        # the rollup buckets of each of them are recounted
+        query = sqlalchemy.select([cache.c.keyword]).distinct().select_from(
+            comments.join(cache, cache.c.comment_id == comments.c.id)
+        ).where(sqlalchemy.and_(comments.c.timestamp >= first,
+                                comments.c.timestamp <= last))
 
-    def count_keyword_mentions(self, text):
-        return text.lower().count(self.keyword)
+        with self.cache_engine.begin() as cn:
+            self.upsert_dataframe(scores_df, scores, cn)
+
+            keywords = [row[0] for row in cn.execute(query)]
+            for bucket_interval in self.rollup_intervals(cn):
+                for keyword in keywords:
+                    self.recount_rollup(keyword, bucket_interval, cn, first,
+                                        last)
 
-    def analyze_sentiment(self, text):
-        return None  # TextBlob(text).sentiment
+        for keyword in keywords:
+            compile_cache.invalidate(self.cache_path, self.collector_name,
+                                     keyword)
+
+        self.next_status()
@@ -65,14 +65,21 @@ class DataAssimilator(object):
     def add_collector(self, collector, keywords=['name', 'symbol'],
                       filters=None):
         column_names = []
-        
-        for keyword in keywords:
 
-            keyword = getattr(self.coin, keyword)
+        keywords = [getattr(self.coin, keyword) for keyword in keywords]
+
+        # collectors that can download several keywords at once share their
+        # downloads, so later keywords are mostly found in the cache
+        shared = {}
+        if collector.shares_keywords:
+            shared['keywords'] = keywords
+
+        for keyword in keywords:
 
             data_collector = collector(keyword=keyword,
                                        start_date=self.start_date,
-                                       end_date=self.end_date)
+                                       end_date=self.end_date,
+                                       **shared)
             data = data_collector.compile()
 
 
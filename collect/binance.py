@@ -1,25 +1,86 @@
+import threading
 import ccxt
 from . import SequentialDataCollector
 from sqlalchemy import Column, Float, DateTime, String
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+
+# exchange shared by every binance collector, so that its connections are
+# reused and its markets are only loaded once per process
+_exchanges = {}
+
+_exchange_lock = threading.Lock()
+
+
+def get_exchange():
+    # the collectors throttle their own requests to the exchange
+    with _exchange_lock:
+        if 'binance' not in _exchanges:
+            _exchanges['binance'] = ccxt.binance({'enableRateLimit': False})
+
+        return _exchanges['binance']
+
+
+def market_key(symbol, quote):
+    # markets quoted in btc are cached under the bare symbol, as they were
+    # before other quotes were supported
+    if quote.upper() == 'BTC':
+        return symbol.lower()
+
+    return '{0}/{1}'.format(symbol, quote).lower()
 
 
 class Binance(SequentialDataCollector):
+
+    # columns used to order and deduplicate the data in columnar storage
+    time_column = 'candle_start'
+    storage_keys = ['keyword', 'candle_start', 'candle_interval']
+
+    # prices are kept at full precision
+    column_dtypes = {'keyword': 'category',
+                     'candle_start': 'datetime64[ns]'}
+
+    # a download holds the markets of every symbol and quote given to the
+    # collector, each paged through in separate requests
+    request_host = 'api.binance.com'
+    throttles_requests = True
+
+    # maximum number of candles returned by a request
+    page_limit = 1000
+
     def __init__(self, keyword, start_date, end_date, sample_interval='20d',
-                 data_resolution='1h'):
+                 data_resolution='1h', quotes=('BTC', ), symbols=None,
+                 market_workers=8, request_rate=10, exchange=None, **kwargs):
+
+        # every symbol is downloaded against every quote. the markets are
+        # cached under market_key, and the collector compiles the market of
+        # its keyword and first quote
+        self.quotes = [quote.upper() for quote in quotes]
+        self.symbols = [keyword.lower()]
+        for symbol in (symbols or []):
+            if symbol.lower() not in self.symbols:
+                self.symbols.append(symbol.lower())
 
-        # current limit of 500 data points
+        markets = [market_key(symbol, quote) for symbol in self.symbols
+                   for quote in self.quotes]
 
         super().__init__(collector_name='binance',
-                         keyword=keyword,
+                         keyword=markets[0],
+                         keywords=markets[1:],
                          start_date=start_date,
                          end_date=end_date,
                          sample_interval=sample_interval,
-                         data_resolution=data_resolution)
+                         data_resolution=data_resolution,
+                         request_rate=request_rate,
+                         **kwargs)
 
-        self.data_resolution_string = data_resolution
-        self.binance = ccxt.binance()
+        # ccxt timeframe of the candles and the number of markets downloaded
+        # at the same time. the shared exchange is used unless one is given
+        self.timeframe = data_resolution
+        self.market_workers = market_workers
+        self.exchange = exchange if exchange is not None else get_exchange()
 
     def define_cache_table(self, Base):
         cache = {'__tablename__': self.collector_name,
@@ -38,22 +99,79 @@ class Binance(SequentialDataCollector):
         self.cache_table = type('Cache', (Base, ), cache)
 
     def download_to_dataframe(self, interval_start, interval_end):
-        since = int(interval_start.timestamp() * 1e3)
-
-        limit = (interval_end - interval_start) // self.data_resolution
-        pair = '{0}/BTC'.format(self.keyword.upper())
-        data = self.binance.fetch_ohlcv(pair, since=since, limit=limit,
-                                        timeframe=self.data_resolution_string)
-
-        interval_df = pd.DataFrame(data, columns=['candle_start',  # end?
-                                                  'open',
-                                                  'high',
-                                                  'low',
-                                                  'close',
-                                                  'volume'])
+        # markets that are not listed on the exchange are skipped
+        pairs = self.listed_pairs()
+
+        # the markets are paged through concurrently on the shared exchange
+        with ThreadPoolExecutor(max_workers=self.market_workers) as executor:
+            candles = executor.map(
+                lambda pair: self.fetch_candles(pair, interval_start,
+                                                interval_end), pairs)
+            market_dfs = [self.candles_to_dataframe(market_candles, key)
+                          for market_candles, key in zip(candles,
+                                                         pairs.values())]
+
+        if not market_dfs:
+            return self.candles_to_dataframe([], self.keyword)
+
+        return pd.concat(market_dfs, ignore_index=True)
+
+    def listed_pairs(self):
+        # cache keys of the markets listed on the exchange by their pair
+        listed = self.load_markets()
+        pairs = {'{0}/{1}'.format(symbol, quote).upper():
+                 market_key(symbol, quote)
+                 for symbol in self.symbols for quote in self.quotes}
+
+        return {pair: key for pair, key in pairs.items() if pair in listed}
+
+    def covered_keywords(self):
+        # markets that are not listed are left uncovered, so that they are
+        # downloaded once they are listed
+        listed = set(self.listed_pairs().values())
+        return [keyword for keyword in self.keywords if keyword in listed]
+
+    def load_markets(self):
+        # the markets of the shared exchange are only requested once
+        with _exchange_lock:
+            if not self.exchange.markets:
+                self.request(self.exchange.load_markets)
+
+        return self.exchange.markets
+
+    def fetch_candles(self, pair, interval_start, interval_end):
+        # page through the candles of the market from the start of the
+        # interval. a short page means there are no later candles
+        since = int(interval_start.replace(
+            tzinfo=timezone.utc).timestamp() * 1e3)
+        until = int(interval_end.replace(
+            tzinfo=timezone.utc).timestamp() * 1e3)
+        step = int(self.data_resolution.total_seconds() * 1e3)
+
+        candles = []
+        while since < until:
+            limit = min(self.page_limit, (until - since + step - 1) // step)
+            page = self.request(self.exchange.fetch_ohlcv, pair,
+                                self.timeframe, since, limit)
+            candles.extend(page)
+
+            if len(page) < limit:
+                break
+
+            since = page[-1][0] + step
+
+        return [candle for candle in candles if candle[0] < until]
+
+    def candles_to_dataframe(self, candles, keyword):
+        interval_df = pd.DataFrame(candles, columns=['candle_start',  # end?
+                                                     'open',
+                                                     'high',
+                                                     'low',
+                                                     'close',
+                                                     'volume'])
 
         interval_df['candle_interval'] = self.data_resolution
-        interval_df['keyword'] = self.keyword
+        interval_df['keyword'] = keyword
         interval_df['candle_start'] = pd.to_datetime(
             interval_df['candle_start'], unit='ms')
 
@@ -68,16 +186,19 @@ class Binance(SequentialDataCollector):
 
         return interval_df
 
+    def is_retryable(self, error):
+        # ccxt raises network errors for throttled requests, timeouts and
+        # exchange outages
+        return isinstance(error, ccxt.NetworkError)
+
     def handle_download_error(self, interval_start, interval_end, error):
         if 'No market symbol' in str(error):
             return
 
-    def dataframe_to_sql(self, cache_df):
+    def dataframe_to_sql(self, cache_df, connection):
         cache_df['candle_interval'] = cache_df['candle_interval'] + self.epoch
 
-        self.merge_dataframe_into_table(cache_df, self.collector_name,
-                                        ['keyword', 'candle_start',
-                                         'candle_interval'])
+        self.upsert_dataframe(cache_df, self.cache_table, connection)
 
     def sql_to_dataframe(self, interval_start, interval_end):
         # load data from cache
@@ -85,8 +206,10 @@ class Binance(SequentialDataCollector):
         query = query.order_by('candle_start')
         cache_df = pd.read_sql(sql=query.statement, con=self.session.bind)
 
-        # convert back to timedeltas
-        cache_df['candle_interval'] = cache_df['candle_interval'] - self.epoch
+        # convert back to timedeltas. markets listed after the interval have
+        # no rows, so the column is parsed before the epoch is subtracted
+        cache_df['candle_interval'] = (pd.to_datetime(
+            cache_df['candle_interval']) - self.epoch)
 
         # return cached data as dataframe
         return cache_df
@@ -102,6 +225,10 @@ class Binance(SequentialDataCollector):
         # return the cache query
         return query
 
+    def cached_density(self, interval_start):
+        # there is one candle per data resolution in each market
+        return len(self.keywords) / self.data_resolution.total_seconds()
+
     def post_cache_routine(self, interval_start, interval_end):
         pass
 
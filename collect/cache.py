@@ -0,0 +1,159 @@
+import threading
+from collections import OrderedDict
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.engine.url import URL
+from sqlalchemy.pool import QueuePool
+
+
+# pragmas applied to every sqlite connection opened on the cache. write ahead
+# logging lets reads run while a download is writing, and a normal
+# synchronous mode is safe under wal while avoiding an fsync per commit
+CACHE_PRAGMAS = (('journal_mode', 'WAL'),
+                 ('synchronous', 'NORMAL'),
+                 ('cache_size', -64000),
+                 ('mmap_size', 268435456),
+                 ('temp_store', 'MEMORY'))
+
+# process-wide registry of cache engines keyed by the path of the database
+_cache_engines = {}
+
+# names of the tables already created for each cache path
+_cache_tables = {}
+
+_cache_lock = threading.Lock()
+
+
+class CompileCache(object):
+
+    def __init__(self, maxsize=128):
+        # compiled dataframes ordered from least to most recently used
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+
+            self.entries.move_to_end(key)
+            data_df = self.entries[key]
+
+        # return a copy so that callers cannot modify the cached result
+        return data_df.copy()
+
+    def put(self, key, data_df):
+        with self.lock:
+            self.entries[key] = data_df.copy()
+            self.entries.move_to_end(key)
+
+            # evict the least recently used results
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, cache_path, collector_name, keyword):
+        # keys start with the cache, collector and keyword that the result
+        # was compiled from
+        prefix = (cache_path, collector_name, keyword)
+        with self.lock:
+            for key in [key for key in self.entries
+                        if key[:len(prefix)] == prefix]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# process-wide cache of the results of DataCollector.compile
+compile_cache = CompileCache()
+
+
+def get_cache_engine(cache_path):
+    # return the shared engine for the cache, creating it on first use
+    with _cache_lock:
+        if cache_path not in _cache_engines:
+            _cache_engines[cache_path] = create_cache_engine(cache_path)
+            _cache_tables[cache_path] = set()
+
+        return _cache_engines[cache_path]
+
+
+def create_cache_engine(cache_path):
+    # create sqlite database natural
+    cache = {'drivername': 'sqlite',
+             'database': cache_path}
+
+    # keep a pool of open connections rather than reconnecting for every
+    # query. connections are only ever used by one thread at a time
+    engine = sqlalchemy.create_engine(
+        URL(**cache), echo=False, poolclass=QueuePool,
+        connect_args={'check_same_thread': False})
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in CACHE_PRAGMAS:
+            cursor.execute('PRAGMA {0} = {1}'.format(pragma, value))
+        cursor.close()
+
+    # return databse engine
+    return engine
+
+
+def create_cache_schema(cache_path, metadata):
+    # add the tables to the database unless they were already created by
+    # another collector in this process
+    engine = get_cache_engine(cache_path)
+
+    with _cache_lock:
+        created = _cache_tables[cache_path]
+        tables = [table for name, table in metadata.tables.items()
+                  if name not in created]
+
+        if tables:
+            metadata.create_all(engine, tables=tables)
+            migrate_cache_columns(engine, tables)
+            migrate_cache_indexes(engine, tables)
+            created.update(table.name for table in tables)
+
+
+def migrate_cache_columns(engine, tables):
+    # create_all skips tables that already exist, so columns added to the
+    # schema after a cache was created are added here. sqlite can only add
+    # columns that are allowed to be null
+    inspector = sqlalchemy.inspect(engine)
+
+    with engine.begin() as cn:
+        for table in tables:
+            existing = {column['name'] for column in
+                        inspector.get_columns(table.name)}
+
+            for column in table.columns:
+                if column.name not in existing:
+                    cn.execute('ALTER TABLE "{0}" ADD COLUMN "{1}" {2}'.format(
+                        table.name, column.name,
+                        column.type.compile(engine.dialect)))
+
+
+def migrate_cache_indexes(engine, tables):
+    # create_all skips tables that already exist, so indexes added to the
+    # schema after a cache was created are added here
+    inspector = sqlalchemy.inspect(engine)
+
+    migrated = False
+    for table in tables:
+        existing = {index['name'] for index in
+                    inspector.get_indexes(table.name)}
+
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+                migrated = True
+
+    # refresh the statistics used by the query planner
+    if migrated:
+        with engine.begin() as cn:
+            cn.execute('ANALYZE')
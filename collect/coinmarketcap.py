@@ -75,8 +75,8 @@ class CoinMarketCapMetaData(DataCollector):
     def handle_download_error(self, interval_start, interval_end, error):
         raise
 
-    def dataframe_to_sql(self, cache_df):
-        cache_df.to_sql(self.collector_name, self.cache_engine,
+    def dataframe_to_sql(self, cache_df, connection):
+        cache_df.to_sql(self.collector_name, connection,
                         if_exists='append', index=False)
 
     def sql_to_dataframe(self, interval_start, interval_end):
@@ -0,0 +1,99 @@
+from bisect import bisect_left, bisect_right
+
+
+class CoverageIndex(object):
+
+    def __init__(self, segments=()):
+        # sorted, disjoint coverage segments are stored as two parallel lists
+        # so that lookups can be done with a binary search on either bound
+        self.starts = []
+        self.ends = []
+
+        for segment_start, segment_end in segments:
+            self.add(segment_start, segment_end)
+
+    def __iter__(self):
+        # yield the coverage segments as [start, end] pairs in order
+        for segment_start, segment_end in zip(self.starts, self.ends):
+            yield [segment_start, segment_end]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __bool__(self):
+        return bool(self.starts)
+
+    def add(self, interval_start, interval_end):
+        # find the block of segments that touch or overlap the new interval.
+        # segments ending before the interval starts and segments starting
+        # after the interval ends are left untouched
+        lower = bisect_left(self.ends, interval_start)
+        upper = bisect_right(self.starts, interval_end)
+
+        # segments that will be absorbed into the merged segment
+        removed = list(zip(self.starts[lower:upper], self.ends[lower:upper]))
+
+        merged_start = interval_start
+        merged_end = interval_end
+        if removed:
+            merged_start = min(merged_start, removed[0][0])
+            merged_end = max(merged_end, removed[-1][1])
+
+        # replace the absorbed segments with the merged segment
+        self.starts[lower:upper] = [merged_start]
+        self.ends[lower:upper] = [merged_end]
+
+        # return the merged segment and the segments that it replaced
+        return (merged_start, merged_end), removed
+
+    def covers(self, interval_start, interval_end):
+        # the only segment that can contain the interval is the last one that
+        # starts at or before the interval start
+        i = bisect_right(self.starts, interval_start) - 1
+        return i >= 0 and interval_end <= self.ends[i]
+
+    def max_end(self, default=None):
+        # latest covered time
+        return self.ends[-1] if self.ends else default
+
+    def overlapping(self, interval_start, interval_end):
+        # return the range of segment positions that overlap the interval
+        lower = bisect_right(self.ends, interval_start)
+        upper = bisect_left(self.starts, interval_end)
+        return lower, upper
+
+    def clip(self, interval_start, interval_end):
+        # trim an interval where it straddles a coverage boundary. Note that
+        # in the case where coverage is entirely within the interval, the
+        # whole interval is kept so that it will be downloaded again.
+        lower, upper = self.overlapping(interval_start, interval_end)
+        if lower >= upper:
+            return [interval_start, interval_end]
+
+        # a segment straddling the start of the interval moves the start up
+        if (self.starts[lower] <= interval_start and
+                self.ends[lower] < interval_end):
+            interval_start = self.ends[lower]
+
+        # a segment straddling the end of the interval moves the end down
+        if (self.starts[upper - 1] > interval_start and
+                self.ends[upper - 1] >= interval_end):
+            interval_end = self.starts[upper - 1]
+
+        return [interval_start, interval_end]
+
+    def gaps(self, interval_start, interval_end):
+        # return the parts of the interval that are not covered
+        lower, upper = self.overlapping(interval_start, interval_end)
+
+        gaps = []
+        gap_start = interval_start
+        for i in range(lower, upper):
+            if self.starts[i] > gap_start:
+                gaps.append([gap_start, self.starts[i]])
+            gap_start = max(gap_start, self.ends[i])
+
+        if gap_start < interval_end:
+            gaps.append([gap_start, interval_end])
+
+        return gaps
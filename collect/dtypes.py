@@ -0,0 +1,34 @@
+import pandas as pd
+
+
+# strings are only stored as categories when they repeat often enough that
+# the codes and the categories take less memory than the strings themselves
+CATEGORY_RATIO = 0.5
+
+
+def normalize_dtypes(data_df, schema):
+    # convert the columns of the dataframe to the compact dtypes given by the
+    # schema. columns of the schema missing from the dataframe are ignored
+    columns = {}
+    for column, dtype in schema.items():
+        if column not in data_df.columns:
+            continue
+
+        series = data_df[column]
+        if dtype == 'category':
+            if (not isinstance(series.dtype, pd.CategoricalDtype) and
+                    series.nunique() <= CATEGORY_RATIO * len(series)):
+                columns[column] = series.astype('category')
+
+        elif dtype == 'datetime64[ns]':
+            if not pd.api.types.is_datetime64_dtype(series):
+                columns[column] = pd.to_datetime(series)
+
+        elif series.dtype != dtype:
+            columns[column] = series.astype(dtype)
+
+    if not columns:
+        return data_df
+
+    # return a new dataframe rather than modifying the caller's
+    return data_df.assign(**columns)
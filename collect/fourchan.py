@@ -2,13 +2,26 @@ from . import CommentCollector
 import pandas as pd
 
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from bs4 import BeautifulSoup
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
 
 
 class FourChanComments(CommentCollector):
+
+    # every result page of a search is a separate request
+    request_host = 'warosu.org'
+    throttles_requests = True
+
     def __init__(self, keyword, start_date, end_date, sample_interval='31d',
-                 data_resolution='1h', board='biz'):
+                 data_resolution='1h', board='biz', prefetch=4, page_rate=4,
+                 timeout=30, **kwargs):
 
         # call the init functions of the parent class
         super().__init__(collector_name='fourchan',
@@ -17,72 +30,152 @@ class FourChanComments(CommentCollector):
                          end_date=end_date,
                          sample_interval=sample_interval,
                          data_resolution=data_resolution,
-                         community_title='board')
+                         community_title='board',
+                         request_rate=page_rate,
+                         **kwargs)
 
         # defining class attributes
         self.board = board
-        self.base_url = 'https://warosu.org/{board}/?'.format(board=self.board)
-
-    def download_to_dataframe(self, interval_start, interval_end):
-        args = {'task': 'search2',
-                'search_text': self.keyword,
-                'search_datefrom': interval_start,
-                'search_dateto': interval_end,
-                'offset': 0}
-
-        text_list = []
-        id_list = []
-        time_list = []
-
-        while 1:
-            url = self.base_url
-
-            for arg, value in args.items():
-                url = '{url}{arg}={value}&'.format(url=url, arg=arg,
-                                                   value=value)
+        self.base_url = 'https://warosu.org/{board}/'.format(board=self.board)
 
-            page = requests.get(url)
+        # number of result pages requested at once and the request timeout
+        # in seconds. the pages are limited to page_rate requests per second
+        self.prefetch = prefetch
+        self.timeout = timeout
 
-            soup = BeautifulSoup(page.content, 'html.parser')
+        # a single http session keeps the connections to warosu alive
+        # between pages, with enough pooled connections for the prefetched
+        # pages. self.session is the cache session of the parent class
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=prefetch)
+        self.http.mount('https://', adapter)
+        self.http.headers.update({'Accept-Encoding': 'gzip, deflate'})
 
-            comments = soup.find_all('blockquote')
-            for comment_text in comments:
-                comment = comment_text.parent
-
-                id = comment.attrs['id']
-                time = comment.find(class_='posttime').attrs['title']
-                time = datetime.utcfromtimestamp(int(time)/1000.0)
-                text = comment.find('blockquote')
-                [t.extract() for t in text('a')]
-                text = text.get_text()
-
-                text_list.append(text)
-                id_list.append(id)
-                time_list.append(time)
-
-            num_comments = len(list(comments))
-
-            if num_comments == 0:
-                break
-            else:
-                args['offset'] += num_comments
+    def download_to_dataframe(self, interval_start, interval_end):
+        # warosu has no OR search, so each keyword sharing the download is
+        # searched in turn and comments found by more than one search are
+        # only kept once
+        keyword_dfs = [self.search_keyword(keyword, interval_start,
+                                           interval_end)
+                       for keyword in self.keywords]
+        cache_df = pd.concat(keyword_dfs, ignore_index=True)
+        cache_df = cache_df.drop_duplicates(subset='id')
 
-        cache_df = pd.DataFrame(list(zip(text_list, id_list, time_list)),
-                                columns=['text', 'id', 'timestamp'])
-        cache_df['keyword'] = self.keyword
         cache_df['board'] = self.board
         cache_df['author'] = 'anon'
         # reorder the fields to be consistent with sqlite cache
-        cache_df = cache_df[['keyword',
-                             'id',
+        cache_df = cache_df[['id',
                              'board',
                              'author',
                              'timestamp',
                              'text']]
 
+        # adding the keyword field to the dataframe
+        cache_df = self.tag_keywords(cache_df)
+
         # return the downloaded data as a dataframe
         return cache_df
 
+    def search_keyword(self, keyword, interval_start, interval_end):
+        args = {'task': 'search2',
+                'search_text': keyword,
+                'search_datefrom': interval_start,
+                'search_dateto': interval_end}
+
+        comments = []
+
+        # the first page gives the page size. most searches end within a
+        # page or two, so the next page is requested on its own and the
+        # batches of pages requested in parallel only double up to prefetch
+        # pages while the pages are full. a short page means the offsets are
+        # misaligned, so the search continues from the actual offset with a
+        # single page
+        offset = 0
+        page_size = None
+        batch_size = 1
+        with ThreadPoolExecutor(max_workers=self.prefetch) as executor:
+            while 1:
+                if page_size is None:
+                    offsets = [offset]
+                else:
+                    offsets = [offset + i * page_size
+                               for i in range(batch_size)]
+
+                pages = executor.map(
+                    lambda page_offset: self.fetch_page(args, page_offset),
+                    offsets)
+
+                for page in pages:
+                    comments.extend(page)
+                    offset += len(page)
+
+                    if not page or len(page) != page_size:
+                        break
+
+                if not page:
+                    break
+
+                if page_size is None:
+                    page_size = len(page)
+                elif len(page) == page_size:
+                    batch_size = min(2 * batch_size, self.prefetch)
+                else:
+                    batch_size = 1
+
+        return pd.DataFrame(comments, columns=['text', 'id', 'timestamp'])
+
+    def fetch_page(self, args, offset):
+        # each page is throttled and retried on its own, so that a failed
+        # page does not restart the search
+        return self.request(self.download_page, args, offset)
+
+    def download_page(self, args, offset):
+        params = dict(args, offset=offset)
+        page = self.http.get(self.base_url, params=params,
+                             timeout=self.timeout)
+        page.raise_for_status()
+
+        return self.parse_page(page.content)
+
+    def parse_page(self, content):
+        # lxml parses the pages in c. the pure python parser is used when
+        # lxml is not installed
+        if lxml is None:
+            return self.parse_page_soup(content)
+
+        comments = []
+        document = lxml.html.fromstring(content)
+        for comment_text in document.iter('blockquote'):
+            comment = comment_text.getparent()
+
+            id = comment.get('id')
+            time = comment.find_class('posttime')[0].get('title')
+            time = datetime.utcfromtimestamp(int(time)/1000.0)
+            for link in comment_text.findall('.//a'):
+                link.drop_tree()
+            text = comment_text.text_content()
+
+            comments.append((text, id, time))
+
+        return comments
+
+    def parse_page_soup(self, content):
+        comments = []
+        soup = BeautifulSoup(content, 'html.parser')
+        for comment_text in soup.find_all('blockquote'):
+            comment = comment_text.parent
+
+            id = comment.attrs['id']
+            time = comment.find(class_='posttime').attrs['title']
+            time = datetime.utcfromtimestamp(int(time)/1000.0)
+            text = comment.find('blockquote')
+            [t.extract() for t in text('a')]
+            text = text.get_text()
+
+            comments.append((text, id, time))
+
+        return comments
+
     def handle_download_error(self, interval_start, interval_end, error):
         # no error handling required as of now
         raise
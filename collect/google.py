@@ -1,16 +1,49 @@
 from . import DataCollector
+from .ratelimit import response_status
+from .storage import SQLiteStorage
 from pytrends.request import TrendReq
+import numpy as np
 import pandas as pd
-import time
+import sqlalchemy
+import threading
 from datetime import datetime
-from sqlalchemy import Column, Integer, DateTime, Boolean, String
+from sqlalchemy import Column, Integer, DateTime, Boolean, Index, String
 
 
 class GoogleTrends(DataCollector):
 
+    # columns used to order and deduplicate the data in columnar storage
+    time_column = 'data_start'
+    storage_keys = ['keyword', 'query_start', 'query_interval', 'data_start']
+
+    # a payload can hold several keywords
+    shares_keywords = True
+
+    # every payload of a download is a separate request
+    request_host = 'trends.google.com'
+    throttles_requests = True
+
+    # number of keywords batched in a payload with the anchor term
+    batch_size = 4
+
+    # trends are integers from 0 to 100 that are rescaled when the windows
+    # are merged
+    column_dtypes = {'keyword': 'category',
+                     'query_start': 'datetime64[ns]',
+                     'data_start': 'datetime64[ns]',
+                     'trend': 'float32'}
+
+    # sample and overlap intervals of the backbone windows at each coarse
+    # resolution. google returns daily data for timeframes of up to 269 days
+    # and weekly data for timeframes of up to five years
+    backbone_windows = {pd.Timedelta('1d'): ('180d', '30d'),
+                        pd.Timedelta('7d'): ('1500d', '180d')}
+
     def __init__(self, keyword, start_date, end_date, category=0,
                  sample_interval='5d', overlap_interval='1d',
-                 data_resolution='1h', wait=1, sleep=00):
+                 data_resolution='1h', request_rate=1, refresh_horizon=None,
+                 anchor=None, backbone_resolution=None, detail_horizon=None,
+                 trend_request=TrendReq, **kwargs):
 
         # unique coverage_identifier for reproduceable data
         self.coverage_interval = (pd.to_timedelta(sample_interval) +
@@ -22,19 +55,60 @@ class GoogleTrends(DataCollector):
                          start_date=start_date,
                          end_date=end_date,
                          sample_interval=sample_interval,
-                         data_resolution=data_resolution)
-
-        # defining class attributes
-        self.wait = wait
-        self.sleep = sleep
+                         data_resolution=data_resolution,
+                         request_rate=request_rate,
+                         **kwargs)
+
+        # defining class attributes. the pytrends clients are created by
+        # trend_request, which can be replaced to request the trends from
+        # elsewhere. a client holds the payload being requested, so each
+        # thread downloading intervals uses a client of its own
         self.category = category
-        self.pytrend = TrendReq(hl='')
-
-        self.request_time = time.time()
+        self.trend_request = trend_request
+        self.pytrends = threading.local()
 
         # convert times to datetime timedelta objects
         self.overlap_interval = pd.to_timedelta(overlap_interval)
 
+        # windows ending within the horizon are refreshed, as google revises
+        # recent trends. settled windows are only downloaded once. the
+        # refresh is disabled if this is None
+        self.refresh_horizon = (pd.to_timedelta(refresh_horizon)
+                                if refresh_horizon is not None else None)
+
+        # start of the cached windows holding rows marked as partial
+        self.partial_windows = set()
+
+        # term requested in every payload when the keywords are batched.
+        # trends are relative to the largest term of a payload, so the
+        # keywords of different payloads are compared through the anchor
+        self.anchor = anchor.lower() if anchor is not None else None
+
+        # coarse trends over the whole range that each detailed window is
+        # scaled to, instead of chaining the detailed windows together, so
+        # that errors do not compound from one window to the next
+        self.backbone = None
+        if backbone_resolution is not None:
+            backbone_resolution = pd.to_timedelta(backbone_resolution)
+            if backbone_resolution not in self.backbone_windows:
+                raise ValueError('backbone resolution must be 1d or 7d')
+
+            backbone_sample, backbone_overlap = self.backbone_windows[
+                backbone_resolution]
+            self.backbone = GoogleTrends(
+                keyword, start_date - backbone_resolution, end_date,
+                category=category, sample_interval=backbone_sample,
+                overlap_interval=backbone_overlap,
+                data_resolution=backbone_resolution,
+                request_rate=request_rate, refresh_horizon=refresh_horizon,
+                anchor=anchor, trend_request=trend_request, **kwargs)
+
+        # detailed windows are only downloaded within the horizon before the
+        # end date, and the backbone is used on its own before it. detail is
+        # downloaded over the whole range if this is None
+        self.detail_horizon = (pd.to_timedelta(detail_horizon)
+                               if detail_horizon is not None else None)
+
     def define_cache_table(self, Base):
 
         cache = {'__tablename__': self.collector_name,
@@ -48,11 +122,41 @@ class GoogleTrends(DataCollector):
                                       primary_key=True),
                  'data_interval': Column(DateTime),
                  'trend': Column(Integer),
-                 'partial': Column(Boolean)}
+                 'partial': Column(Boolean),
+                 'anchor': Column(Integer),
+                 '__table_args__': (
+                     Index('ix_{0}_window'.format(self.collector_name),
+                           'keyword', 'query_interval', 'query_start',
+                           'data_start'),)}
 
         self.cache_table = type('Cache', (Base, ), cache)
 
     def download_to_dataframe(self, interval_start, interval_end):
+        # each keyword is requested on its own, or in batches of up to four
+        # keywords that share a payload with the anchor term
+        if self.anchor is None:
+            batches = [[keyword] for keyword in self.keywords]
+        else:
+            keywords = [keyword for keyword in self.keywords
+                        if keyword != self.anchor]
+            batches = [keywords[i:i + self.batch_size]
+                       for i in range(0, len(keywords), self.batch_size)]
+
+        def on_retry(error, delay):
+            self.status('QUERY LIMIT REACHED'
+                        if response_status(error) == 429
+                        else 'GOOGLE SERVER ERROR', interval_start,
+                        interval_end)
+
+        keyword_dfs = [self.request(self.download_payload, batch,
+                                    interval_start, interval_end,
+                                    on_retry=on_retry)
+                       for batch in batches or [[]]]
+
+        # return downloaded data as dataframe
+        return pd.concat(keyword_dfs, ignore_index=True)
+
+    def download_payload(self, keywords, interval_start, interval_end):
         # define time format required for google trends api
         time_format = '%Y-%m-%dT%H'
 
@@ -60,15 +164,17 @@ class GoogleTrends(DataCollector):
         interval_start_str = interval_start.strftime(time_format)
         interval_end_str = interval_end.strftime(time_format)
 
+        # the anchor is the last term of every batched payload
+        terms = list(keywords)
+        if self.anchor is not None:
+            terms.append(self.anchor)
+
         # send request to google for the trend data
         timeframe = '{0} {1}'.format(interval_start_str, interval_end_str)
-        self.pytrend.build_payload([self.keyword], cat=self.category,
-                                   timeframe=timeframe)
+        pytrend = self.trend_client()
+        pytrend.build_payload(terms, cat=self.category, timeframe=timeframe)
 
-        # allow wait time between requests
-        time.sleep(max(0, self.wait - (time.time() - self.request_time)))
-        interval_df = self.pytrend.interest_over_time()
-        self.request_time = time.time()
+        interval_df = pytrend.interest_over_time()
 
         # handle the empty dataframe case. if pytrends returns an empty
         # dataframe, populate one with 0 trend
@@ -84,64 +190,132 @@ class GoogleTrends(DataCollector):
                 start_time = interval_start + i * self.data_resolution
                 end_time = start_time + self.data_resolution
                 partial = True if end_time > datetime.utcnow() else False
-                empty_result.append([start_time, 0, partial])
+                empty_result.append([start_time] + [0] * len(terms) +
+                                    [partial])
 
             # create dataframe to complete interval but with 0 trend data
-            interval_df = pd.DataFrame(empty_result, columns=['date',
-                                                              self.keyword,
-                                                              'isPartial'])
+            interval_df = pd.DataFrame(empty_result,
+                                       columns=['date'] + terms +
+                                       ['isPartial'])
             interval_df = interval_df.set_index('date')
 
-        # return dataframe of interval
-        cache_df = interval_df
-        cache_df['keyword'] = self.keyword
-        cache_df['query_start'] = interval_start
-        cache_df['query_interval'] = (self.sample_interval +
-                                      self.overlap_interval)
-        cache_df['data_start'] = pd.to_datetime(interval_df.index)
-        cache_df['data_interval'] = (interval_df.index[1] -
-                                     interval_df.index[0])
-        cache_df['isPartial'] = cache_df['isPartial'].astype(bool).astype(int)
-
-        cache_df = cache_df.rename(columns={self.keyword: 'trend',
-                                            'isPartial': 'partial'})
-        cache_df = cache_df.reset_index(drop=True)
-
-        cache_df = cache_df[['keyword',
-                             'query_start',
-                             'query_interval',
-                             'data_start',
-                             'data_interval',
-                             'trend',
-                             'partial']]
-
-        # return downloaded data as dataframe
-        return cache_df
+        data_start = pd.to_datetime(interval_df.index)
+        partial = interval_df['isPartial'].astype(bool).astype(int).values
+
+        # the anchor is cached alongside each keyword of the payload so that
+        # the keywords can be rescaled to it. the anchor is also cached as a
+        # keyword when the collector is searching for it
+        cached = list(keywords)
+        if self.anchor in self.keywords:
+            cached.append(self.anchor)
+
+        keyword_dfs = []
+        for keyword in cached:
+            keyword_dfs.append(pd.DataFrame({
+                'keyword': keyword,
+                'query_start': interval_start,
+                'query_interval': (self.sample_interval +
+                                   self.overlap_interval),
+                'data_start': data_start,
+                'data_interval': data_start[1] - data_start[0],
+                'trend': interval_df[keyword].values,
+                'partial': partial,
+                'anchor': (interval_df[self.anchor].values
+                           if self.anchor is not None else None)}))
+
+        return pd.concat(keyword_dfs, ignore_index=True)
+
+    def trend_client(self):
+        # the pytrends client of the current thread, created on first use
+        client = getattr(self.pytrends, 'client', None)
+        if client is None:
+            client = self.pytrends.client = self.trend_request(hl='')
+
+        return client
+
+    def download_data(self):
+        # windows holding partial rows are refreshed along with the recent
+        # windows
+        if self.refresh_horizon is not None:
+            self.partial_windows = self.load_partial_windows()
+
+        # the backbone is downloaded before the detailed windows scaled to it
+        if self.backbone is not None:
+            self.backbone.download_data()
+
+        return super().download_data()
+
+    def load_partial_windows(self):
+        query_interval = (self.sample_interval + self.overlap_interval +
+                          self.epoch)
+
+        if not isinstance(self.storage, SQLiteStorage):
+            cache_df = self.storage.read(
+                self.start_date - self.sample_interval,
+                self.end_date + self.sample_interval)
+            if cache_df.empty:
+                return set()
+
+            cache_df = cache_df[cache_df['partial'].astype(bool)]
+            return {pd.Timestamp(query_start).to_pydatetime()
+                    for query_start in cache_df['query_start'].unique()}
+
+        table = self.cache_table.__table__
+        query = sqlalchemy.select([table.c.query_start]).distinct().where(
+            sqlalchemy.and_(table.c.keyword == self.keyword,
+                            table.c.query_interval == query_interval,
+                            table.c.partial == sqlalchemy.true()))
+
+        with self.cache_engine.connect() as cn:
+            return {row[0] for row in cn.execute(query)}
+
+    def is_cache_complete(self, interval_start, interval_end):
+        if self.refresh_horizon is None:
+            return super().is_cache_complete(interval_start, interval_end)
+
+        # older windows are complete once they are covered, unless google
+        # marked some of their rows as partial when they were downloaded
+        now = datetime.utcnow()
+        if interval_end <= now - self.refresh_horizon:
+            if interval_start in self.partial_windows:
+                return False
+
+            return self.coverage.covers(interval_start, interval_end)
+
+        # recent windows are refreshed at most once per data resolution
+        max_coverage_end = self.coverage.max_end(
+            default=datetime.utcfromtimestamp(0))
+        return now - max_coverage_end < self.data_resolution
 
     def handle_download_error(self, interval_start, interval_end, error):
 
-        # catch blocked ip error. this may happen if there are too many request
-        # over a short period of time. this is sometimes resolved witha one
-        # minute buffer
-        error_code = str(error)[-4:-1]
-        if error_code == '429':
+        # the request was still blocked or failing once the retries ran out.
+        # the interval is left out of the coverage and downloaded on the
+        # next run. pytrends errors carry the response of the failed request
+        status = response_status(error)
+        if status == 429:
             # update status source and display status
             self.status('QUERY LIMIT REACHED', interval_start, interval_end)
-            if self.sleep:
-                time.sleep(self.sleep)
-                return self.query_interval(interval_start, interval_end)
-            else:
-                pass
-        elif error_code == '500':
+        elif status is not None and status >= 500:
             self.status('GOOGLE SERVER ERROR', interval_start, interval_end)
-            pass
         else:
             raise
 
-    def dataframe_to_sql(self, cache_df):
+    def dataframe_to_sql(self, cache_df, connection):
+        # replace the windows being written for every keyword in the download
+        table = self.cache_table.__table__
+        keywords = cache_df['keyword'].drop_duplicates().tolist()
+        query_starts = [pd.Timestamp(query_start).to_pydatetime()
+                        for query_start in cache_df['query_start'].unique()]
+        connection.execute(table.delete().where(sqlalchemy.and_(
+            table.c.keyword.in_(keywords),
+            table.c.query_start.in_(query_starts),
+            table.c.query_interval == (self.sample_interval +
+                                       self.overlap_interval + self.epoch))))
+
         cache_df['query_interval'] = cache_df['query_interval'] + self.epoch
         cache_df['data_interval'] = cache_df['data_interval'] + self.epoch
-        cache_df.to_sql(self.collector_name, self.cache_engine,
+        cache_df.to_sql(self.collector_name, connection,
                         if_exists='append', index=False)
 
     def sql_to_dataframe(self, interval_start, interval_end):
@@ -150,9 +324,10 @@ class GoogleTrends(DataCollector):
         query = query.order_by('data_start')
         cache_df = pd.read_sql(sql=query.statement, con=self.session.bind)
 
-        # convert back to timedeltas
-        cache_df['query_interval'] = cache_df['query_interval'] - self.epoch
-        cache_df['data_interval'] = cache_df['data_interval'] - self.epoch
+        # convert back to timedeltas. the columns are parsed first, as an
+        # empty result is not read as datetimes
+        for column in ['query_interval', 'data_interval']:
+            cache_df[column] = pd.to_datetime(cache_df[column]) - self.epoch
 
         # return cached data as dataframe
         return cache_df
@@ -177,14 +352,26 @@ class GoogleTrends(DataCollector):
         pass
 
     def pre_cache_routine(self, interval_start, interval_end):
-        query = self.interval_sql_query(interval_start, interval_end)
-        query.delete(synchronize_session=False)
-        self.session.commit()
+        # the windows are replaced when they are written to the cache
+        pass
+
+    def compile_options(self):
+        backbone_resolution = (self.backbone.data_resolution
+                               if self.backbone is not None else None)
+        return (backbone_resolution, self.detail_horizon)
+
+    def detail_start(self):
+        # start of the detailed windows
+        if self.backbone is None or self.detail_horizon is None:
+            return self.start_date
+
+        return max(self.start_date, self.end_date - self.detail_horizon)
 
     def download_intervals(self):
         # push back the start date so that there is an natural number of
         # intervals between the epoch and the start
-        query_start = (self.start_date - (self.start_date - self.epoch) %
+        start_date = self.detail_start()
+        query_start = (start_date - (start_date - self.epoch) %
                        self.sample_interval)
 
         # push forward the end date so that there are a natural number of
@@ -212,44 +399,137 @@ class GoogleTrends(DataCollector):
         return intervals
 
     def process_raw_data(self, data_df):
-        data_df = self.merge_overlap(data_df)
-
-        return data_df.loc[self.start_date:self.end_date]
+        data_df = self.rescale_to_anchor(data_df)
 
-    def merge_overlap(self, data_df):
-
-        intervals = self.download_intervals()
-
-        keyword_df = pd.DataFrame()
-        for interval_start, interval_end in intervals:
-            interval_df = data_df[(data_df['query_start'] ==
-                                   interval_start) &
-                                  (data_df['data_start'] >=
-                                   interval_start) &
-                                  (data_df['data_start'] <
-                                   interval_end)].copy()
-
-            interval_df = interval_df.set_index('data_start')
-            if keyword_df.empty:
-                keyword_df = interval_df
-
-            else:
-                previous_times = keyword_df.index
-                interval_times = interval_df.index
-
-                overlap = previous_times.intersection(interval_times)
+        if self.backbone is None:
+            data_df = self.merge_overlap(data_df)
+        else:
+            data_df = self.scale_to_backbone(data_df)
 
-                top_overlap_df = keyword_df.loc[overlap]
-                bottom_overlap_df = interval_df.loc[overlap]
+        return data_df.loc[self.start_date:self.end_date]
 
-                normalization_factor = (top_overlap_df['trend'].mean() /
-                                        bottom_overlap_df['trend'].mean())
-                interval_df.loc[:, 'trend'] *= normalization_factor
+    def rescale_to_anchor(self, data_df):
+        # trends from batched payloads are rescaled so that the anchor has a
+        # mean of 100 over each window. windows downloaded without an anchor
+        # are left as they are
+        if 'anchor' not in data_df.columns or data_df['anchor'].isna().all():
+            return data_df
 
-                interval_df = interval_df.loc[interval_start +
-                                              self.overlap_interval:]
+        anchor_mean = data_df.groupby('query_start')['anchor'].transform(
+            'mean')
+        trend = data_df['trend'] * 100 / anchor_mean
 
-                keyword_df = keyword_df.append(interval_df)
+        return data_df.assign(trend=trend.where(data_df['anchor'].notna(),
+                                                data_df['trend']))
 
-        keyword_df = keyword_df[['trend']]
+    def merge_overlap(self, data_df):
+        # each window is scaled by the ratio of the mean trend of the previous
+        # window to its own over the times they have in common. the ratios
+        # are chained with a cumulative product from the first window with
+        # data, so a window without data breaks the chain for those after it
+        rows_df, window_starts = self.window_rows(data_df)
+        if rows_df.empty:
+            return rows_df.set_index('data_start')[['trend']]
+
+        # pair each row with the same time in the previous window
+        previous_df = rows_df.assign(window=rows_df['window'] + 1)
+        common_df = rows_df.merge(previous_df, on=['window', 'data_start'],
+                                  suffixes=('', '_previous'))
+        means_df = common_df.groupby('window')[['trend_previous',
+                                                'trend']].mean()
+
+        first_window = rows_df['window'].iloc[0]
+        ratios = (means_df['trend_previous'] / means_df['trend']).reindex(
+            range(first_window, len(window_starts)))
+        ratios[first_window] = 1
+        factors = ratios.cumprod(skipna=False)
+
+        # scale every window and drop the overlap from all but the first
+        rows_df['trend'] = rows_df['trend'] * factors.reindex(
+            rows_df['window']).values
+
+        return self.drop_overlap(rows_df, window_starts)
+
+    def scale_to_backbone(self, data_df):
+        # each detailed window is scaled by the ratio of the mean backbone
+        # trend to its own mean trend over the backbone periods it covers,
+        # so that every window is scaled independently of the others. the
+        # backbone is read over all of its windows, as its first window
+        # starts long before the start date
+        read_start, read_end = self.backbone.read_bounds(
+            self.backbone.download_intervals())
+        backbone_df = self.backbone.process_raw_data(
+            self.backbone.storage.read(read_start, read_end))
+        rows_df, window_starts = self.window_rows(data_df)
+
+        # backbone trend of the period holding each row. rows outside the
+        # periods of the backbone have no backbone trend
+        data_start = rows_df['data_start'].values
+        periods = np.searchsorted(backbone_df.index.values, data_start,
+                                  side='right') - 1
+        backbone_trend = pd.Series(
+            backbone_df['trend'].values).reindex(periods).values
+        period_ends = pd.Series(
+            backbone_df.index + self.backbone.data_resolution).reindex(
+                periods).values
+        backbone_trend[~(data_start < period_ends)] = np.nan
+
+        means_df = rows_df.assign(backbone=backbone_trend).dropna(
+            subset=['backbone']).groupby('window')[['backbone',
+                                                    'trend']].mean()
+
+        # windows without any trend are left at zero
+        factors = (means_df['backbone'] / means_df['trend']).where(
+            means_df['trend'] != 0, 1)
+        rows_df['trend'] = rows_df['trend'] * factors.reindex(
+            rows_df['window']).values
+
+        detail_df = self.drop_overlap(rows_df, window_starts)
+
+        # the backbone trend is repeated at the data resolution before the
+        # detailed windows
+        detail_start = (detail_df.index[0] if not detail_df.empty
+                        else self.end_date)
+        coarse_index = pd.date_range(self.start_date, detail_start,
+                                     freq=self.data_resolution,
+                                     inclusive='left', name='data_start')
+        coarse_df = backbone_df[['trend']].reindex(coarse_index,
+                                                   method='ffill')
+
+        return pd.concat([coarse_df, detail_df])
+
+    def window_rows(self, data_df):
+        # rows of the planned windows that fall inside them, numbered by
+        # window and in time order
+        window_starts = [interval_start for interval_start, _ in
+                         self.download_intervals()]
+        window_size = self.sample_interval + self.overlap_interval
+
+        data_df = data_df[data_df['query_start'].isin(window_starts) &
+                          (data_df['data_start'] >= data_df['query_start']) &
+                          (data_df['data_start'] < data_df['query_start'] +
+                           window_size)]
+
+        positions = pd.Series(range(len(window_starts)), index=window_starts)
+        rows_df = pd.DataFrame({
+            'window': positions.reindex(data_df['query_start']).values,
+            'data_start': pd.to_datetime(data_df['data_start'].values),
+            'trend': data_df['trend'].values})
+        rows_df = rows_df.sort_values(['window', 'data_start'])
+
+        return rows_df, window_starts
+
+    def drop_overlap(self, rows_df, window_starts):
+        # drop the overlap from all but the first window with data
+        if rows_df.empty:
+            return rows_df.set_index('data_start')[['trend']]
+
+        first_window = rows_df['window'].iloc[0]
+        window_starts = pd.Series(window_starts).reindex(
+            rows_df['window']).values
+        rows_df = rows_df[(rows_df['window'] == first_window) |
+                          (rows_df['data_start'] >= window_starts +
+                           self.overlap_interval)]
+
+        keyword_df = rows_df.set_index('data_start')[['trend']]
         return keyword_df
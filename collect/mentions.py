@@ -0,0 +1,24 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+
+
+def count_mentions(texts, keywords):
+    # count the occurrences of every keyword in every text. the texts are
+    # lowercased once rather than once per keyword, and each keyword is
+    # counted with str.count mapped over the texts so that the loop runs in
+    # c without a python call per text. a regular expression scan, either
+    # per keyword or for all the keywords at once, is slower than the
+    # substring search of str.count when the keywords are mentioned often
+    keywords = [keyword.lower() for keyword in keywords]
+    lowered = list(map(str.lower, texts.fillna('').astype(str)))
+
+    counts = np.zeros((len(lowered), len(keywords)), dtype=np.int64)
+    for i, keyword in enumerate(keywords):
+        counts[:, i] = np.fromiter(
+            map(str.count, lowered, itertools.repeat(keyword)),
+            dtype=np.int64, count=len(lowered))
+
+    # return one column of mention counts per keyword
+    return pd.DataFrame(counts, index=texts.index, columns=keywords)
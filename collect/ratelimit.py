@@ -0,0 +1,160 @@
+import itertools
+import random
+import threading
+import time
+
+
+class RateLimiter(object):
+
+    def __init__(self, rate=None, burst=1):
+        # token bucket refilled at rate tokens per second, holding at most
+        # burst tokens. no limit if rate is None
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+        # no request is allowed before this time while the host is backing
+        # off
+        self.resume = self.updated
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # block until a token is available. each caller takes its token up
+        # front, leaving the bucket in debt if it is empty, so that
+        # concurrent workers are spaced evenly instead of polling
+        with self.lock:
+            now = time.monotonic()
+            wait = self.resume - now
+
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                self.tokens -= 1
+                wait = max(wait, -self.tokens / self.rate)
+
+        time.sleep(max(0, wait))
+
+    def pause(self, seconds):
+        # hold back every request to the host for the given time
+        with self.lock:
+            self.resume = max(self.resume, time.monotonic() + seconds)
+
+
+class RetryBudget(object):
+
+    def __init__(self, ratio=0.2, reserve=10):
+        # each request earns ratio retries and each retry spends one, so
+        # that retries stay a fraction of the requests when a host is
+        # failing. a reserve of retries is available from the start
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = reserve
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.reserve, self.tokens + self.ratio)
+
+    def withdraw(self):
+        # return whether a retry is allowed, spending it if it is
+        with self.lock:
+            if self.tokens < 1:
+                return False
+
+            self.tokens -= 1
+            return True
+
+
+class RequestThrottle(object):
+
+    def __init__(self, rate=None, burst=1, max_retries=5, base_delay=1,
+                 max_delay=60):
+        # rate limit, retry budget and backoff shared by the requests to a
+        # host
+        self.limiter = RateLimiter(rate, burst)
+        self.budget = RetryBudget()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def configure(self, rate=None, burst=None, max_retries=None):
+        # settings left as None keep their current value
+        if rate is not None:
+            self.limiter.rate = rate
+        if burst is not None:
+            self.limiter.burst = burst
+        if max_retries is not None:
+            self.max_retries = max_retries
+
+    def acquire(self):
+        self.limiter.acquire()
+
+    def call(self, function, *args, retryable=None, on_retry=None):
+        # call the function once a token is available, retrying the errors
+        # accepted by retryable until the retries or the budget run out
+        self.budget.deposit()
+
+        for attempt in itertools.count():
+            self.limiter.acquire()
+
+            try:
+                return function(*args)
+
+            except Exception as error:
+                if (retryable is None or not retryable(error) or
+                        attempt >= self.max_retries or
+                        not self.budget.withdraw()):
+                    raise
+
+                delay = self.backoff(attempt, error)
+                if on_retry is not None:
+                    on_retry(error, delay)
+
+                # the whole host backs off, since the other workers would
+                # only be throttled as well
+                self.limiter.pause(delay)
+
+    def backoff(self, attempt, error=None):
+        # exponential backoff with full jitter, so that the workers that
+        # failed together do not retry together. a delay asked for by the
+        # server is always respected
+        delay = random.uniform(0, min(self.max_delay,
+                                      self.base_delay * 2 ** attempt))
+
+        return max(delay, retry_after(error))
+
+
+def retry_after(error):
+    # seconds to wait given by the Retry-After header of a failed response
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After', 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+def response_status(error):
+    # http status code of the response that raised the error, if any
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+# throttles shared by every collector requesting the same host
+throttles = {}
+throttles_lock = threading.Lock()
+
+
+def get_throttle(host, rate=None, burst=None, max_retries=None):
+    # the throttle of the host, created on first use. the settings are
+    # updated when they are given
+    with throttles_lock:
+        throttle = throttles.get(host)
+        if throttle is None:
+            throttle = throttles[host] = RequestThrottle()
+
+        throttle.configure(rate, burst, max_retries)
+
+    return throttle
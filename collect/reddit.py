@@ -1,14 +1,20 @@
 from . import CommentCollector
 from psaw import PushshiftAPI
-from datetime import timezone
+from datetime import datetime, timedelta, timezone
 import pandas as pd
 
 # from textblob import TextBlob
 
 
 class RedditComments(CommentCollector):
+
+    # host of the pushshift api searched by psaw
+    request_host = 'api.pushshift.io'
+
     def __init__(self, keyword, start_date, end_date, sample_interval='31d',
-                 data_resolution='1h', subreddit='cryptocurrency'):
+                 data_resolution='1h', subreddit='cryptocurrency',
+                 stream_chunk_size=None, request_rate=1, reddit=None,
+                 **kwargs):
 
         # call the init functions of the parent class
         super().__init__(collector_name='reddit',
@@ -17,33 +23,69 @@ class RedditComments(CommentCollector):
                          end_date=end_date,
                          sample_interval=sample_interval,
                          data_resolution=data_resolution,
-                         community_title='subreddit')
+                         community_title='subreddit',
+                         request_rate=request_rate,
+                         **kwargs)
 
-        # defining class attributes
-        self.reddit = PushshiftAPI()
+        # defining class attributes. a pushshift client is created unless
+        # one is given
+        self.reddit = reddit if reddit is not None else PushshiftAPI()
         self.subreddit = subreddit
 
+        # number of comments written to the cache at a time while an
+        # interval is downloading. the whole interval is downloaded before
+        # it is cached if this is None
+        self.stream_chunk_size = stream_chunk_size
+
     def download_to_dataframe(self, interval_start, interval_end):
-        # download comments over a given interval
+        # download comments over a given interval. the keywords sharing the
+        # download are combined into a single OR query. streamed comments
+        # are requested oldest first so that each chunk ends at a checkpoint
+        sort = {'sort': 'asc', 'sort_type': 'created_utc'}
         results_gen = self.reddit.search_comments(
-            q=self.keyword,
+            q='|'.join(self.keywords),
             subreddit=self.subreddit,
             filter=['id', 'subreddit', 'author', 'created_utc', 'body'],
             after=int(interval_start.replace(
                 tzinfo=timezone.utc).timestamp()),
             before=int(interval_end.replace(
-                tzinfo=timezone.utc).timestamp()))
+                tzinfo=timezone.utc).timestamp()),
+            **(sort if self.stream_chunk_size else {}))
+
+        if self.stream_chunk_size:
+            return self.stream_to_cache(results_gen, interval_start)
 
         # convert downlaoded data to a pandas dataframe
-        cache_df = pd.DataFrame(results_gen)
+        return self.results_to_dataframe(results_gen)
+
+    def stream_to_cache(self, results_gen, interval_start):
+        # write the comments to the cache in chunks as they are downloaded.
+        # each chunk is covered up to the second before its last comment,
+        # since later comments can share that second, so that an interrupted
+        # download resumes from the last chunk that was cached
+        results = []
+        for result in results_gen:
+            results.append(result)
+            if len(results) < self.stream_chunk_size:
+                continue
+
+            checkpoint = (datetime.utcfromtimestamp(results[-1].created_utc) -
+                          timedelta(seconds=1))
+            if checkpoint > interval_start:
+                self.cache_interval(interval_start, checkpoint,
+                                    self.results_to_dataframe(results))
+                results = []
+
+        # the remaining comments are cached with the rest of the interval
+        return self.results_to_dataframe(results)
+
+    def results_to_dataframe(self, results):
+        cache_df = pd.DataFrame(results)
 
         # if there is no data, return the empty dataframe as is
         if cache_df.empty:
             return cache_df
 
-        # adding the keyword field to the dataframe
-        cache_df['keyword'] = self.keyword
-
         # renaming fields for convenience
         cache_df = cache_df.rename(columns={'created_utc': 'timestamp',
                                             'body': 'text'})
@@ -52,13 +94,15 @@ class RedditComments(CommentCollector):
         cache_df['timestamp'] = pd.to_datetime(cache_df['timestamp'], unit='s')
 
         # reorder the fields to be consistent with sqlite cache
-        cache_df = cache_df[['keyword',
-                             'id',
+        cache_df = cache_df[['id',
                              'subreddit',
                              'author',
                              'timestamp',
                              'text']]
 
+        # adding the keyword field to the dataframe
+        cache_df = self.tag_keywords(cache_df)
+
         # return the downloaded data as a dataframe
         return cache_df
 
@@ -0,0 +1,30 @@
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from textblob import TextBlob
+except ImportError:
+    TextBlob = None
+
+
+def score_texts(texts):
+    # polarity of each text, from -1 for negative to 1 for positive
+    return [TextBlob(text).sentiment.polarity for text in texts]
+
+
+def score_sentiment(texts, max_workers=None, batch_size=1000):
+    # score the texts in batches spread across a pool of processes, since
+    # scoring is bound by the cpu rather than by io
+    if TextBlob is None:
+        raise ImportError('textblob is required for sentiment scoring')
+
+    batches = [texts[i:i + batch_size]
+               for i in range(0, len(texts), batch_size)]
+
+    # a single batch is not worth starting the pool for
+    if max_workers == 1 or len(batches) <= 1:
+        scores = map(score_texts, batches)
+        return [score for batch in scores for score in batch]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        scores = executor.map(score_texts, batches)
+        return [score for batch in scores for score in batch]
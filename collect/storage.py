@@ -0,0 +1,303 @@
+import os
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from urllib.parse import quote
+
+import pandas as pd
+import sqlalchemy
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+class CacheStorage(ABC):
+
+    def __init__(self, collector):
+        # the storage reads and writes the cache of a single collector
+        self.collector = collector
+
+    @abstractmethod
+    def begin(self, interval_start, interval_end):
+        raise NotImplementedError
+
+    @abstractmethod
+    def write(self, cache_df, transaction):
+        raise NotImplementedError
+
+    @abstractmethod
+    def read(self, interval_start, interval_end):
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_chunks(self, interval_start, interval_end, chunksize):
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_coverage(self, keyword):
+        raise NotImplementedError
+
+    @abstractmethod
+    def write_coverage(self, keyword, coverage, merged, removed,
+                       transaction):
+        raise NotImplementedError
+
+
+class SQLiteStorage(CacheStorage):
+
+    def begin(self, interval_start, interval_end):
+        # the data and coverage of an interval are written in one transaction
+        return self.collector.cache_engine.begin()
+
+    def write(self, cache_df, transaction):
+        # dataframe_to_sql is defined by child class
+        self.collector.dataframe_to_sql(cache_df, transaction)
+
+    def read(self, interval_start, interval_end):
+        # sql_to_dataframe is defined by child class
+        return self.collector.normalize_dtypes(
+            self.collector.sql_to_dataframe(interval_start, interval_end))
+
+    def read_chunks(self, interval_start, interval_end, chunksize):
+        # sql_to_chunks is defined by child class
+        for chunk in self.collector.sql_to_chunks(interval_start,
+                                                  interval_end, chunksize):
+            yield self.collector.normalize_dtypes(chunk)
+
+    def load_coverage(self, keyword):
+        collector = self.collector
+
+        # load the coverage intervals from the sqlite database
+        query = collector.session.query(collector.coverage_table)
+        query = query.filter((collector.coverage_table.keyword == keyword),
+                             (collector.coverage_table.coverage_interval
+                              == collector.coverage_interval))
+        coverage_df = pd.read_sql(sql=query.statement,
+                                  con=collector.session.bind)
+
+        # create an empty dataframe if there is no coverage
+        if coverage_df.empty:
+            coverage_df = pd.DataFrame(data=None,
+                                       columns=coverage_df.columns,
+                                       index=coverage_df.index)
+
+        # convert dataframe to nested list for easier handling
+        coverage = coverage_df[['query_start', 'query_end']].values.tolist()
+        for i, interval in enumerate(coverage):
+            for b, bound in enumerate(interval):
+                coverage[i][b] = pd.Timestamp(bound).to_pydatetime()
+
+        return coverage
+
+    def write_coverage(self, keyword, coverage, merged, removed,
+                       transaction):
+        collector = self.collector
+        table = collector.coverage_table.__table__
+
+        # remove the coverage intervals that were absorbed by the merge
+        if removed:
+            transaction.execute(table.delete().where(sqlalchemy.and_(
+                table.c.keyword == keyword,
+                table.c.coverage_interval == collector.coverage_interval,
+                table.c.query_start.in_([start for start, _ in removed]))))
+
+        # add the merged coverage interval to the sqlite database
+        transaction.execute(table.insert().prefix_with('OR REPLACE'),
+                            keyword=keyword,
+                            query_start=merged[0],
+                            coverage_interval=collector.coverage_interval,
+                            query_end=merged[1])
+
+
+class ParquetStorage(CacheStorage):
+
+    # format of the interval bounds in the names of the parquet files
+    file_time_format = '%Y%m%dT%H%M%S'
+
+    def __init__(self, collector):
+        super().__init__(collector)
+
+        if pa is None:
+            raise ImportError('pyarrow is required for the parquet cache')
+
+        # data is partitioned by collector, coverage interval, keyword and
+        # month of the collector's time column
+        coverage_interval = int((collector.coverage_interval -
+                                 collector.epoch).total_seconds())
+        self.root = os.path.join(
+            '{0}-parquet'.format(os.path.splitext(collector.cache_path)[0]),
+            collector.collector_name,
+            'interval={0}'.format(coverage_interval))
+
+        self.partitioning = ds.partitioning(
+            pa.schema([('month', pa.string())]), flavor='hive')
+
+    @contextmanager
+    def begin(self, interval_start, interval_end):
+        # files are staged during the transaction and only moved into place
+        # when it completes. data is moved before coverage so that a crash
+        # can only ever leave data that is not yet marked as covered
+        transaction = {'interval': (interval_start, interval_end),
+                       'data': [],
+                       'coverage': []}
+        yield transaction
+
+        for path, table in transaction['data'] + transaction['coverage']:
+            directory, file_name = os.path.split(path)
+            os.makedirs(directory, exist_ok=True)
+
+            # hidden files are skipped when the dataset is read
+            temp_path = os.path.join(directory, '.{0}'.format(file_name))
+            pq.write_table(table, temp_path)
+            os.replace(temp_path, path)
+
+    def keyword_path(self, keyword):
+        # keywords are uri encoded so that they are safe as directory names
+        return os.path.join(self.root, 'keyword={0}'.format(
+            quote(keyword, safe='')))
+
+    def write(self, cache_df, transaction):
+        time_column = self.collector.time_column
+        interval_start, interval_end = transaction['interval']
+
+        # each interval is written to its own file in every month partition
+        # so that downloading the interval again replaces the file
+        file_name = '{0}-{1}.parquet'.format(
+            interval_start.strftime(self.file_time_format),
+            interval_end.strftime(self.file_time_format))
+
+        cache_df = cache_df.sort_values(time_column)
+        months = cache_df[time_column].dt.strftime('%Y-%m')
+
+        for (keyword, month), month_df in cache_df.groupby(
+                [cache_df['keyword'], months], sort=False, observed=True):
+            path = os.path.join(self.keyword_path(keyword),
+                                'month={0}'.format(month), file_name)
+
+            # the keyword is stored in the partition path, not the file.
+            # categories are stored as plain values so that every file has
+            # the same schema
+            month_df = month_df.drop(columns='keyword')
+            month_df = month_df.astype({
+                column: month_df[column].cat.categories.dtype
+                for column in month_df.select_dtypes('category')})
+
+            table = pa.Table.from_pandas(month_df, preserve_index=False)
+            transaction['data'].append((path, table))
+
+    def scan(self, interval_start, interval_end):
+        time_column = self.collector.time_column
+        keyword_path = self.keyword_path(self.collector.keyword)
+
+        if not os.path.isdir(keyword_path):
+            return None, None
+
+        # the month filter prunes partitions, the time filter is pushed down
+        # to the row groups of the remaining files
+        dataset = ds.dataset(keyword_path, format='parquet',
+                             partitioning=self.partitioning)
+
+        month = ds.field('month')
+        timestamp = ds.field(time_column)
+        expression = ((month >= interval_start.strftime('%Y-%m')) &
+                      (month <= interval_end.strftime('%Y-%m')) &
+                      (timestamp >= pd.Timestamp(interval_start)) &
+                      (timestamp <= pd.Timestamp(interval_end)))
+
+        return dataset, expression
+
+    def to_dataframe(self, table):
+        collector = self.collector
+
+        cache_df = table.to_pandas()
+        cache_df = cache_df.drop(columns='month')
+        cache_df.insert(0, 'keyword', collector.keyword)
+
+        # intervals that were downloaded more than once may hold duplicates
+        cache_df = cache_df.drop_duplicates(subset=collector.storage_keys,
+                                            keep='last')
+        cache_df = cache_df.sort_values(collector.time_column)
+
+        return collector.normalize_dtypes(cache_df.reset_index(drop=True))
+
+    def empty_dataframe(self, interval_start, interval_end):
+        # a keyword without cached rows reads as an empty dataframe with the
+        # columns of the cache schema, as it does from the sqlite cache
+        query = self.collector.interval_sql_query(interval_start,
+                                                  interval_end)
+        cache_df = pd.read_sql(sql=query.limit(0).statement,
+                               con=self.collector.cache_engine)
+
+        return self.collector.normalize_dtypes(cache_df)
+
+    def read(self, interval_start, interval_end):
+        dataset, expression = self.scan(interval_start, interval_end)
+        if dataset is None:
+            return self.empty_dataframe(interval_start, interval_end)
+
+        # return cached data as dataframe
+        return self.to_dataframe(dataset.to_table(filter=expression))
+
+    def read_chunks(self, interval_start, interval_end, chunksize):
+        dataset, expression = self.scan(interval_start, interval_end)
+        if dataset is None:
+            yield self.empty_dataframe(interval_start, interval_end)
+            return
+
+        # every copy of a row is stored in the month partition of its time,
+        # so each month is deduplicated as a whole before it is split into
+        # chunks. only a single month is held in memory at a time
+        months = sorted(
+            name.split('=', 1)[1]
+            for name in os.listdir(self.keyword_path(self.collector.keyword))
+            if name.startswith('month='))
+        months = [month for month in months
+                  if interval_start.strftime('%Y-%m') <= month <=
+                  interval_end.strftime('%Y-%m')]
+
+        empty = True
+        for month in months:
+            table = dataset.to_table(filter=expression &
+                                     (ds.field('month') == month))
+            if not table.num_rows:
+                continue
+
+            month_df = self.to_dataframe(table)
+            for i in range(0, len(month_df), chunksize):
+                yield month_df.iloc[i:i + chunksize]
+
+            empty = False
+
+        if empty:
+            yield self.empty_dataframe(interval_start, interval_end)
+
+    def coverage_path(self, keyword):
+        return os.path.join(self.root, '_coverage', '{0}.parquet'.format(
+            quote(keyword, safe='')))
+
+    def load_coverage(self, keyword):
+        path = self.coverage_path(keyword)
+        if not os.path.exists(path):
+            return []
+
+        coverage_df = pq.read_table(path).to_pandas()
+        return [[pd.Timestamp(start).to_pydatetime(),
+                 pd.Timestamp(end).to_pydatetime()]
+                for start, end in coverage_df[['query_start',
+                                               'query_end']].values]
+
+    def write_coverage(self, keyword, coverage, merged, removed,
+                       transaction):
+        # the coverage of a keyword is a handful of merged intervals so the
+        # whole index is rewritten rather than patched
+        coverage_df = pd.DataFrame(list(coverage),
+                                   columns=['query_start', 'query_end'])
+        table = pa.Table.from_pandas(coverage_df, preserve_index=False)
+        transaction['coverage'].append((self.coverage_path(keyword), table))
+
+
+STORAGE_BACKENDS = {'sqlite': SQLiteStorage,
+                    'parquet': ParquetStorage}
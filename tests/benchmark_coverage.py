@@ -0,0 +1,65 @@
+import timeit
+from datetime import datetime, timedelta
+
+from collect.coverage import CoverageIndex
+
+
+def list_is_covered(coverage, interval_start, interval_end):
+    # previous linear scan used by DataCollector.is_cache_complete
+    for coverage_start, coverage_end in coverage:
+        if (interval_start >= coverage_start and
+                interval_end <= coverage_end):
+            return True
+    return False
+
+
+def list_clip(coverage, interval_start, interval_end):
+    # previous linear scan used by SequentialDataCollector.download_intervals
+    interval = [interval_start, interval_end]
+    for coverage_start, coverage_end in coverage:
+        overlap = max(timedelta(0), min(interval[1], coverage_end) -
+                      max(interval[0], coverage_start))
+        if overlap > timedelta(0):
+            if interval[0] < coverage_end and interval[1] > coverage_end:
+                interval[0] = coverage_end
+            if interval[1] > coverage_start and interval[0] < coverage_start:
+                interval[1] = coverage_start
+    return interval
+
+
+def build_coverage(num_segments):
+    # hourly segments separated by one hour gaps
+    epoch = datetime(2016, 1, 1)
+    return [[epoch + timedelta(hours=2 * i),
+             epoch + timedelta(hours=2 * i + 1)]
+            for i in range(num_segments)]
+
+
+def run(num_segments=5000, num_intervals=2000, repeat=3):
+    coverage = build_coverage(num_segments)
+    index = CoverageIndex(coverage)
+
+    epoch = coverage[0][0]
+    intervals = [(epoch + timedelta(hours=i, minutes=10),
+                  epoch + timedelta(hours=i, minutes=50))
+                 for i in range(0, 2 * num_segments, max(
+                     1, 2 * num_segments // num_intervals))]
+
+    timings = {
+        'list covers': lambda: [list_is_covered(coverage, *i)
+                                for i in intervals],
+        'index covers': lambda: [index.covers(*i) for i in intervals],
+        'list clip': lambda: [list_clip(coverage, *i) for i in intervals],
+        'index clip': lambda: [index.clip(*i) for i in intervals],
+    }
+
+    print('{0} coverage segments, {1} intervals'.format(num_segments,
+                                                        len(intervals)))
+    for name, function in timings.items():
+        seconds = min(timeit.repeat(function, number=1, repeat=repeat))
+        print('{name: <15} {seconds:10.4f}s'.format(name=name,
+                                                    seconds=seconds))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,52 @@
+import random
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from collect import CommentCollector
+from collect.dtypes import normalize_dtypes
+
+
+def build_comments(num_comments, num_authors=2000):
+    # comments as they are returned by a download, with python strings and
+    # datetimes in object columns
+    rng = random.Random(0)
+    epoch = datetime(2018, 1, 1)
+
+    return pd.DataFrame({
+        'keyword': ['bitcoin'] * num_comments,
+        'id': [str(i) for i in range(num_comments)],
+        'board': ['biz'] * num_comments,
+        'author': ['user{0}'.format(rng.randrange(num_authors))
+                   for _ in range(num_comments)],
+        'timestamp': pd.Series([epoch + timedelta(seconds=30 * i)
+                                for i in range(num_comments)], dtype=object),
+        'text': ['buy bitcoin now'] * num_comments})
+
+
+def memory(data_df):
+    return data_df.memory_usage(deep=True, index=False)
+
+
+def run(num_comments=200000):
+    comments_df = build_comments(num_comments)
+
+    schema = dict(CommentCollector.column_dtypes, board='category')
+    normalized_df = normalize_dtypes(comments_df, schema)
+
+    before = memory(comments_df)
+    after = memory(normalized_df)
+
+    print('{0} comments'.format(num_comments))
+    for column in comments_df.columns:
+        print('{column: <10} {before:10.1f}MB {after:10.1f}MB '
+              '{dtype}'.format(column=column, before=before[column] / 1e6,
+                               after=after[column] / 1e6,
+                               dtype=normalized_df[column].dtype))
+
+    print('{0: <10} {1:10.1f}MB {2:10.1f}MB'.format(
+        'total', before.sum() / 1e6, after.sum() / 1e6))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,50 @@
+import random
+import timeit
+
+import pandas as pd
+
+from collect.mentions import count_mentions
+
+
+def apply_count(texts, keywords):
+    # previous per keyword apply used by CommentCollector.process_raw_data
+    return pd.DataFrame({keyword: texts.apply(
+        lambda text: text.lower().count(keyword)) for keyword in keywords})
+
+
+def build_texts(num_comments, num_words=40, vocabulary_size=50):
+    # comments of random words from a small vocabulary, so that the
+    # keywords are mentioned often
+    rng = random.Random(0)
+    vocabulary = ['Bitcoin', 'ETH', 'ethereum', 'doge', 'moon', 'buy',
+                  'sell', 'hodl'] + ['word{0}'.format(i)
+                                     for i in range(vocabulary_size)]
+
+    return pd.Series([' '.join(rng.choice(vocabulary)
+                               for _ in range(num_words))
+                      for _ in range(num_comments)])
+
+
+def run(num_comments=200000, repeat=3):
+    texts = build_texts(num_comments)
+    keyword_sets = [['bitcoin'],
+                    ['bitcoin', 'eth', 'doge'],
+                    ['bitcoin', 'eth', 'ethereum', 'doge', 'moon', 'buy',
+                     'sell', 'hodl', 'word1', 'word2']]
+
+    print('{0} comments'.format(num_comments))
+    for keywords in keyword_sets:
+        timings = {
+            'apply count': lambda: apply_count(texts, keywords),
+            'count mentions': lambda: count_mentions(texts, keywords),
+        }
+
+        for name, function in timings.items():
+            seconds = min(timeit.repeat(function, number=1, repeat=repeat))
+            print('{name: <15} {num_keywords:3d} keywords {seconds:10.4f}s'
+                  ''.format(name=name, num_keywords=len(keywords),
+                            seconds=seconds))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,97 @@
+import timeit
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from collect.google import GoogleTrends
+
+
+class ExampleTrends(GoogleTrends):
+    def __init__(self, start_date, end_date, sample_interval='5d',
+                 overlap_interval='1d', data_resolution='1h'):
+        # only the attributes used to plan and merge the windows are set, so
+        # that no cache or trends session is created
+        self.start_date = start_date
+        self.end_date = end_date
+        self.epoch = datetime.utcfromtimestamp(0)
+        self.sample_interval = pd.to_timedelta(sample_interval)
+        self.overlap_interval = pd.to_timedelta(overlap_interval)
+        self.data_resolution = pd.to_timedelta(data_resolution)
+        self.backbone = None
+
+
+def loop_merge_overlap(collector, data_df):
+    # previous loop used by GoogleTrends.merge_overlap
+    intervals = collector.download_intervals()
+
+    keyword_df = pd.DataFrame()
+    for interval_start, interval_end in intervals:
+        interval_df = data_df[(data_df['query_start'] == interval_start) &
+                              (data_df['data_start'] >= interval_start) &
+                              (data_df['data_start'] < interval_end)].copy()
+
+        interval_df = interval_df.set_index('data_start')
+        if keyword_df.empty:
+            keyword_df = interval_df
+
+        else:
+            overlap = keyword_df.index.intersection(interval_df.index)
+
+            normalization_factor = (
+                keyword_df.loc[overlap]['trend'].mean() /
+                interval_df.loc[overlap]['trend'].mean())
+            interval_df.loc[:, 'trend'] *= normalization_factor
+
+            interval_df = interval_df.loc[interval_start +
+                                          collector.overlap_interval:]
+
+            keyword_df = pd.concat([keyword_df, interval_df])
+
+    return keyword_df[['trend']]
+
+
+def build_windows(collector, seed=0):
+    # hourly windows of a random walk, each scaled to a maximum of 100 like
+    # the trends api does
+    rng = np.random.default_rng(seed)
+
+    window_dfs = []
+    for interval_start, interval_end in collector.download_intervals():
+        data_start = pd.date_range(interval_start, interval_end,
+                                   freq=collector.data_resolution,
+                                   inclusive='left')
+        trend = np.cumsum(rng.random(len(data_start)) + 0.5)
+        window_dfs.append(pd.DataFrame({
+            'keyword': 'bitcoin',
+            'query_start': interval_start,
+            'data_start': data_start,
+            'trend': np.round(100 * trend / trend.max())}))
+
+    return pd.concat(window_dfs, ignore_index=True)
+
+
+def run(years=3, repeat=3):
+    collector = ExampleTrends(datetime(2016, 1, 1),
+                              datetime(2016 + years, 1, 1))
+    data_df = build_windows(collector)
+
+    loop_df = loop_merge_overlap(collector, data_df)
+    merged_df = collector.merge_overlap(data_df)
+    pd.testing.assert_frame_equal(loop_df, merged_df, check_dtype=False)
+
+    timings = {
+        'loop': lambda: loop_merge_overlap(collector, data_df),
+        'vectorized': lambda: collector.merge_overlap(data_df),
+    }
+
+    print('{0} windows, {1} rows'.format(
+        len(collector.download_intervals()), len(data_df)))
+    for name, function in timings.items():
+        seconds = min(timeit.repeat(function, number=1, repeat=repeat))
+        print('{name: <15} {seconds:10.4f}s'.format(name=name,
+                                                    seconds=seconds))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,74 @@
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from collect import CommentCollector
+
+
+class ExampleComments(CommentCollector):
+    def __init__(self, keyword, cache_name, **kwargs):
+        super().__init__(collector_name='example',
+                         keyword=keyword,
+                         start_date=datetime(2018, 1, 1),
+                         end_date=datetime(2018, 3, 1),
+                         community_title='board',
+                         cache_name=cache_name,
+                         **kwargs)
+
+    def download_to_dataframe(self, interval_start, interval_end):
+        # a comment every hour mentioning the keyword
+        timestamps = pd.date_range(interval_start, interval_end, freq='1h',
+                                   inclusive='left')
+        comments_df = pd.DataFrame({
+            'id': [str(int(t.timestamp())) for t in timestamps],
+            'board': 'biz',
+            'author': 'anon',
+            'timestamp': timestamps,
+            'text': 'buy {0} now'.format(self.keyword)})
+
+        return self.tag_keywords(comments_df)
+
+    def handle_download_error(self, interval_start, interval_end, error):
+        raise
+
+
+class ExampleTrendReq(object):
+
+    def __init__(self, popularity=None):
+        # steady search volume of each term, and the timeframes and terms of
+        # the payloads that were requested
+        self.popularity = popularity or {}
+        self.requests = []
+        self.payloads = []
+
+    def build_payload(self, terms, cat=0, timeframe=''):
+        self.terms = terms
+        self.timeframe = timeframe
+        self.payloads.append(terms)
+
+    def interest_over_time(self):
+        # hourly trends up to the current hour, which google marks as
+        # partial. the trends are relative to the largest term of the
+        # payload
+        interval_start, interval_end = [
+            datetime.strptime(t, '%Y-%m-%dT%H')
+            for t in self.timeframe.split()]
+        self.requests.append((interval_start, interval_end))
+
+        now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        index = pd.date_range(interval_start, min(interval_end, now),
+                              freq='1h', name='date')
+        volumes = {term: self.popularity.get(term, 50)
+                   for term in self.terms}
+        interval_df = pd.DataFrame(
+            {term: volume * 100 // max(volumes.values())
+             for term, volume in volumes.items()}, index=index)
+        interval_df['isPartial'] = index >= now
+
+        return interval_df
+
+
+@pytest.fixture
+def cache_name(tmp_path):
+    return str(tmp_path / 'cache.sqlite')
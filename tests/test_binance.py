@@ -0,0 +1,91 @@
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+pytest.importorskip('ccxt')
+
+from collect.binance import Binance  # noqa: E402
+
+
+class ExampleExchange(object):
+
+    # an hourly candle of every listed market from the listing onwards
+    markets = {'ETH/BTC': datetime(2018, 1, 1),
+               'LTC/BTC': datetime(2018, 1, 2)}
+
+    def __init__(self):
+        self.requests = []
+
+    def load_markets(self):
+        return self.markets
+
+    def fetch_ohlcv(self, pair, timeframe, since, limit):
+        self.requests.append((pair, since, limit))
+
+        step = 3600 * 1000
+        listed = int(self.markets[pair].replace(
+            tzinfo=timezone.utc).timestamp() * 1e3)
+        start = max(since, listed)
+
+        return [[t, 1.0, 1.0, 1.0, 1.0, 1.0]
+                for t in range(start, start + limit * step, step)]
+
+
+class ExampleBinance(Binance):
+
+    # a few candles to a page, so that every interval is paged through
+    page_limit = 50
+
+    def __init__(self, keyword, cache_name, **kwargs):
+        super().__init__(keyword, datetime(2018, 1, 1), datetime(2018, 1, 11),
+                         sample_interval='5d', request_rate=0,
+                         cache_name=cache_name, **kwargs)
+
+
+@pytest.fixture
+def local_time(monkeypatch):
+    # a host clock that is not set to utc
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_candles_are_paged_in_utc(cache_name, local_time):
+    exchange = ExampleExchange()
+    collector = ExampleBinance('eth', cache_name, exchange=exchange)
+    interval_start, interval_end = next(iter(collector.download_intervals()))
+    cache_df = collector.download_to_dataframe(interval_start, interval_end)
+
+    # the pages follow on from each other from the start of the interval
+    step = 3600 * 1000
+    since = int(interval_start.replace(
+        tzinfo=timezone.utc).timestamp() * 1e3)
+    assert exchange.requests[0] == ('ETH/BTC', since, 50)
+    assert all(request[1] == previous[1] + previous[2] * step
+               for previous, request in zip(exchange.requests,
+                                            exchange.requests[1:]))
+
+    # every candle of the interval is downloaded once
+    hours = (interval_end - interval_start) // collector.data_resolution
+    assert len(cache_df) == hours
+    assert cache_df['candle_start'].is_unique
+    assert cache_df['candle_start'].iloc[0] == interval_start
+    assert cache_df['candle_start'].iloc[-1] < interval_end
+
+
+def test_unlisted_markets_are_left_uncovered(cache_name):
+    exchange = ExampleExchange()
+    collector = ExampleBinance('eth', cache_name, symbols=['ltc', 'xrp'],
+                               exchange=exchange)
+    compiled_df = collector.compile()
+
+    assert len(compiled_df) == 10 * 24 + 1
+    assert collector.coverage.covers(collector.start_date,
+                                     collector.end_date)
+    assert collector.keyword_coverage('ltc')
+    assert not collector.keyword_coverage('xrp')
+    assert {pair for pair, _, _ in exchange.requests} == {'ETH/BTC',
+                                                          'LTC/BTC'}
@@ -0,0 +1,159 @@
+from datetime import datetime
+
+import pytest
+
+from .conftest import ExampleComments, ExampleTrendReq
+
+
+def query_plan(collector, query):
+    # run EXPLAIN QUERY PLAN on the sql generated for an orm query
+    sql = query.statement.compile(collector.cache_engine,
+                                  compile_kwargs={'literal_binds': True})
+
+    with collector.cache_engine.connect() as cn:
+        rows = cn.exec_driver_sql(
+            'EXPLAIN QUERY PLAN {0}'.format(sql)).fetchall()
+
+    return [row[-1] for row in rows]
+
+
+def assert_no_full_scans(plan):
+    scans = [step for step in plan if step.startswith('SCAN')]
+    assert not scans, plan
+
+
+def test_comment_interval_query_uses_indexes(cache_name):
+    collector = ExampleComments('bitcoin', cache_name)
+    query = collector.interval_sql_query(datetime(2018, 1, 1),
+                                         datetime(2018, 2, 1))
+    assert_no_full_scans(query_plan(collector, query.order_by('timestamp')))
+
+
+def test_coverage_query_uses_indexes(cache_name):
+    collector = ExampleComments('bitcoin', cache_name)
+    table = collector.coverage_table
+    query = collector.session.query(table).filter(
+        table.keyword == collector.keyword,
+        table.coverage_interval == collector.coverage_interval)
+
+    plan = query_plan(collector, query)
+    assert_no_full_scans(plan)
+    assert any('ix_example-coverage_interval' in step for step in plan)
+
+
+def test_google_trends_query_uses_indexes(cache_name):
+    pytest.importorskip('pytrends')
+    from collect.google import GoogleTrends
+
+    collector = GoogleTrends('bitcoin', datetime(2018, 1, 1),
+                             datetime(2018, 2, 1), cache_name=cache_name,
+                             trend_request=lambda hl: ExampleTrendReq())
+    query = collector.interval_sql_query(datetime(2018, 1, 1),
+                                         datetime(2018, 2, 1))
+
+    plan = query_plan(collector, query.order_by('data_start'))
+    assert_no_full_scans(plan)
+    assert any('ix_google-trends_window' in step for step in plan)
+
+
+def test_missing_indexes_are_migrated(cache_name):
+    collector = ExampleComments('bitcoin', cache_name)
+    index_name = 'ix_example-comments_timestamp'
+
+    # simulate a cache created before the index was part of the schema
+    with collector.cache_engine.begin() as cn:
+        cn.exec_driver_sql('DROP INDEX "{0}"'.format(index_name))
+
+    from collect import cache
+    cache._cache_tables[collector.cache_path].clear()
+
+    collector = ExampleComments('bitcoin', cache_name)
+    with collector.cache_engine.connect() as cn:
+        names = [row[0] for row in cn.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")]
+
+    assert index_name in names
+
+
+def test_reindex_holds_coverage_of_contained_keywords(cache_name):
+    ExampleComments('bitcoin', cache_name).compile()
+
+    # every comment mentioning bitcoin cash was caught by the bitcoin search
+    collector = ExampleComments('Bitcoin Cash', cache_name)
+    assert collector.reindex_cached_comments() == 0
+    assert collector.coverage.covers(collector.start_date,
+                                     collector.end_date)
+
+    collector = ExampleComments('Bitcoin Cash', cache_name)
+    assert collector.coverage.covers(collector.start_date,
+                                     collector.end_date)
+
+
+def test_reindex_links_mentions_without_coverage(cache_name):
+    ethereum = ExampleComments('ethereum', cache_name)
+    ethereum_df = ethereum.compile()
+    num_comments = len(ethereum.storage.read(datetime(2017, 1, 1),
+                                             datetime(2019, 1, 1)))
+
+    # the cached comments mentioning ethereum also mention eth, but the
+    # comments mentioning only eth were never searched for
+    collector = ExampleComments('ETH', cache_name)
+    assert collector.reindex_cached_comments() == num_comments
+    assert not collector.coverage
+
+    compiled_df = collector.compile(download=False)
+    assert compiled_df['mentions'].sum() == ethereum_df['mentions'].sum()
+
+
+def test_text_index_follows_comment_changes(cache_name):
+    collector = ExampleComments('bitcoin', cache_name)
+    collector.compile()
+    if not collector.text_index_name:
+        pytest.skip('sqlite was built without fts5')
+
+    num_comments = len(collector.search_comments('bitcoin'))
+    comments = '"{0}"'.format(collector.comment_table_name)
+    with collector.cache_engine.begin() as cn:
+        first, second = [row[0] for row in cn.exec_driver_sql(
+            'SELECT id FROM {0} LIMIT 2'.format(comments))]
+        cn.exec_driver_sql('UPDATE {0} SET text = \'sell ethereum\' '
+                           'WHERE id = ?'.format(comments), (first, ))
+        cn.exec_driver_sql('DELETE FROM {0} WHERE id = ?'.format(comments),
+                           (second, ))
+
+    assert collector.search_comments('ethereum')['id'].tolist() == [first]
+    assert len(collector.search_comments('bitcoin')) == num_comments - 2
+
+
+def test_text_index_keyed_by_id_is_rebuilt(cache_name):
+    collector = ExampleComments('bitcoin', cache_name)
+    collector.compile()
+    if not collector.text_index_name:
+        pytest.skip('sqlite was built without fts5')
+
+    # simulate an index created before it was keyed by rowid
+    fts = collector.text_index_name
+    comments = collector.comment_table_name
+    with collector.cache_engine.begin() as cn:
+        cn.exec_driver_sql('DROP TRIGGER "{0}-delete"'.format(fts))
+        cn.exec_driver_sql('DROP TABLE "{0}"'.format(fts))
+        cn.exec_driver_sql('CREATE VIRTUAL TABLE "{0}" USING '
+                           'fts5(id UNINDEXED, text)'.format(fts))
+        cn.exec_driver_sql(
+            'CREATE TRIGGER "{0}-delete" AFTER DELETE ON "{1}" BEGIN DELETE '
+            'FROM "{0}" WHERE id = old.id; END'.format(fts, comments))
+
+    collector = ExampleComments('bitcoin', cache_name)
+    num_comments = len(collector.storage.read(datetime(2017, 1, 1),
+                                              datetime(2019, 1, 1)))
+    assert len(collector.search_comments('bitcoin')) == num_comments
+
+
+def test_text_search_without_fts5_is_a_runtime_error(cache_name):
+    collector = ExampleComments('bitcoin', cache_name)
+    collector.text_index_name = None
+
+    with pytest.raises(RuntimeError) as error:
+        collector.search_comments('bitcoin')
+
+    assert type(error.value) is RuntimeError
@@ -0,0 +1,140 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip('bs4')
+pytest.importorskip('requests')
+
+from collect.fourchan import FourChanComments  # noqa: E402
+
+
+# posts on the board, one every six hours
+POSTS = [('{0} and {1}'.format(*pair), str(i),
+          datetime(2018, 1, 1) + timedelta(hours=6 * i))
+         for i, pair in enumerate([('bitcoin', 'ethereum'),
+                                   ('bitcoin', 'moon'),
+                                   ('ethereum', 'gas')] * 40)]
+
+
+class ExampleFourChan(FourChanComments):
+
+    # number of comments on a full result page
+    page_size = 5
+
+    def __init__(self, keyword, cache_name, **kwargs):
+        super().__init__(keyword, datetime(2018, 1, 1),
+                         datetime(2018, 1, 31), sample_interval='10d',
+                         cache_name=cache_name, page_rate=0, **kwargs)
+        self.offsets = []
+
+    def download_page(self, args, offset):
+        # the page of search results warosu would return at the offset
+        self.offsets.append((args['search_text'], offset))
+        results = [post for post in POSTS
+                   if args['search_text'] in post[0] and
+                   args['search_datefrom'] <= post[2] < args['search_dateto']]
+
+        return results[offset:offset + self.page_size]
+
+
+class SlowFourChan(ExampleFourChan):
+
+    # longest time in seconds a page is held back waiting for other pages
+    page_timeout = 0.5
+
+    def __init__(self, keyword, cache_name, **kwargs):
+        super().__init__(keyword, cache_name, **kwargs)
+        self.requested = threading.Condition()
+        self.pending = 0
+        self.max_pending = 0
+        self.releases = 0
+
+    def download_page(self, args, offset):
+        # each page is held back until prefetch pages are requested at the
+        # same time, or until the timeout for the smaller batches
+        with self.requested:
+            releases = self.releases
+            self.pending += 1
+            self.max_pending = max(self.max_pending, self.pending)
+            if self.pending >= self.prefetch:
+                self.releases += 1
+                self.requested.notify_all()
+
+            self.requested.wait_for(lambda: self.releases > releases,
+                                    self.page_timeout)
+
+        page = super().download_page(args, offset)
+
+        with self.requested:
+            self.pending -= 1
+
+        return page
+
+
+def test_compile_counts_mentions(cache_name):
+    collector = ExampleFourChan('bitcoin', cache_name)
+    compiled_df = collector.compile()
+
+    mentions = [post for post in POSTS if 'bitcoin' in post[0] and
+                post[2] <= datetime(2018, 1, 31)]
+    assert compiled_df['mentions'].sum() == len(mentions)
+
+    # the cached comments are read back through the cache session
+    cache_df = collector.sql_to_dataframe(datetime(2018, 1, 1),
+                                          datetime(2018, 1, 31))
+    assert set(cache_df['id']) == {post[1] for post in mentions}
+
+
+def test_shared_download_covers_every_keyword(cache_name):
+    keywords = ['bitcoin', 'ethereum']
+    collector = ExampleFourChan('bitcoin', cache_name, keywords=keywords)
+    collector.compile()
+
+    # the second keyword is served from the cache of the shared download
+    collector = ExampleFourChan('ethereum', cache_name, keywords=keywords)
+    compiled_df = collector.compile()
+
+    mentions = [post for post in POSTS if 'ethereum' in post[0] and
+                post[2] <= datetime(2018, 1, 31)]
+    assert compiled_df['mentions'].sum() == len(mentions)
+    assert collector.offsets == []
+
+
+def test_short_search_is_not_prefetched(cache_name):
+    collector = ExampleFourChan('bitcoin', cache_name)
+    comments_df = collector.search_keyword('bitcoin', datetime(2018, 1, 1),
+                                           datetime(2018, 1, 2))
+
+    # the first page is short, so only the page after it is requested
+    assert len(comments_df) == 3
+    assert collector.offsets == [('bitcoin', 0), ('bitcoin', 3)]
+
+
+def test_long_search_is_prefetched(cache_name):
+    collector = ExampleFourChan('bitcoin', cache_name)
+    comments_df = collector.search_keyword('bitcoin', datetime(2018, 1, 1),
+                                           datetime(2018, 2, 1))
+
+    mentions = [post for post in POSTS if 'bitcoin' in post[0]]
+    assert comments_df['id'].tolist() == [post[1] for post in mentions]
+
+    # the full pages and the empty page after them, and at most a batch
+    # of pages past the end
+    num_pages = len(mentions) // collector.page_size + 1
+    assert len(collector.offsets) <= num_pages + collector.prefetch - 1
+
+
+def test_prefetched_pages_are_requested_together(cache_name):
+    collector = SlowFourChan('bitcoin', cache_name)
+    comments_df = collector.search_keyword('bitcoin', datetime(2018, 1, 1),
+                                           datetime(2018, 2, 1))
+
+    # the pages of a long search are requested prefetch at a time, and each
+    # page is requested once
+    assert len(comments_df) == 80
+    assert collector.max_pending == collector.prefetch
+
+    offsets = sorted(offset for _, offset in collector.offsets)
+    assert offsets == list(range(0, len(offsets) * collector.page_size,
+                                 collector.page_size))
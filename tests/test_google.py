@@ -0,0 +1,166 @@
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip('pytrends')
+
+from collect.google import GoogleTrends  # noqa: E402
+
+from .conftest import ExampleTrendReq  # noqa: E402
+
+
+class SlowTrendReq(ExampleTrendReq):
+
+    def interest_over_time(self):
+        # the payload is read back after the request has taken some time
+        time.sleep(0.01)
+        return super().interest_over_time()
+
+
+Response = namedtuple('Response', 'status_code headers')
+
+
+class ThrottledTrendReq(ExampleTrendReq):
+
+    def interest_over_time(self):
+        # pytrends raises with the response of the failed request, and the
+        # message no longer ends in a period
+        self.requests.append(self.timeframe)
+        error = Exception('The request failed: Google returned a response '
+                          'with code 429')
+        error.response = Response(429, {})
+        raise error
+
+
+def compile_trends(keyword, start, end, cache_name, pytrend, **kwargs):
+    collector = GoogleTrends(keyword, start, end, request_rate=0,
+                             cache_name=cache_name,
+                             trend_request=lambda hl: pytrend, **kwargs)
+    collector.compile()
+
+    return collector
+
+
+def age_coverage(collector, hours):
+    # pretend the coverage was downloaded hours earlier
+    with collector.cache_engine.begin() as cn:
+        cn.exec_driver_sql(
+            'update "google-trends-coverage" '
+            'set query_end = datetime(query_end, "-{0} hours")'.format(hours))
+
+
+def test_rerun_refreshes_recent_windows(cache_name):
+    end = datetime.utcnow()
+    start = end - timedelta(days=60)
+    pytrend = ExampleTrendReq()
+
+    collector = compile_trends('bitcoin', start, end, cache_name, pytrend,
+                               refresh_horizon='3d')
+    num_windows = len(collector.download_intervals())
+    assert len(pytrend.requests) == num_windows
+
+    # nothing is downloaded again within the data resolution
+    pytrend.requests.clear()
+    compile_trends('bitcoin', start, end, cache_name, pytrend,
+                   refresh_horizon='3d')
+    assert pytrend.requests == []
+
+    # later on, only the windows within the refresh horizon are downloaded
+    # again
+    age_coverage(collector, 2)
+    compile_trends('bitcoin', start, end, cache_name, pytrend,
+                   refresh_horizon='3d')
+    assert 1 <= len(pytrend.requests) <= 2
+    assert all(interval_end > end - timedelta(days=3)
+               for _, interval_end in pytrend.requests)
+
+
+def test_partial_window_is_refreshed(cache_name):
+    end = datetime.utcnow()
+    start = end - timedelta(days=60)
+    pytrend = ExampleTrendReq()
+
+    collector = compile_trends('bitcoin', start, end, cache_name, pytrend,
+                               refresh_horizon='3d')
+
+    # the first window was downloaded while its last rows were partial
+    with collector.cache_engine.begin() as cn:
+        cn.exec_driver_sql(
+            'update "google-trends" set partial = 1 where query_start = '
+            '(select min(query_start) from "google-trends")')
+
+    pytrend.requests.clear()
+    compile_trends('bitcoin', start, end, cache_name, pytrend,
+                   refresh_horizon='3d')
+    assert pytrend.requests == [collector.download_intervals()[0]]
+
+    # the refreshed window is settled
+    pytrend.requests.clear()
+    compile_trends('bitcoin', start, end, cache_name, pytrend,
+                   refresh_horizon='3d')
+    assert pytrend.requests == []
+
+
+def test_batched_keywords_share_payloads(cache_name):
+    start, end = datetime(2018, 1, 1), datetime(2018, 3, 1)
+    keywords = ['btc', 'eth', 'ltc', 'xrp', 'ada', 'dot', 'sol', 'doge']
+    popularity = {'bitcoin': 100, 'btc': 200, 'eth': 40, 'ltc': 20,
+                  'xrp': 60, 'ada': 10, 'dot': 30, 'sol': 50, 'doge': 80}
+
+    pytrend = ExampleTrendReq(popularity)
+    for keyword in keywords:
+        compile_trends(keyword, start, end, cache_name, pytrend,
+                       keywords=keywords)
+    num_requests = len(pytrend.requests)
+
+    # four keywords are requested with the anchor in each payload
+    batched_cache_name = cache_name.replace('.sqlite', '-batched.sqlite')
+    pytrend = ExampleTrendReq(popularity)
+    trends = {}
+    for keyword in keywords:
+        collector = compile_trends(keyword, start, end, batched_cache_name,
+                                   pytrend, keywords=keywords,
+                                   anchor='bitcoin')
+        trends[keyword] = collector.compile()['trend']
+
+    assert len(pytrend.requests) * 4 == num_requests
+    assert all(len(terms) <= 5 and terms[-1] == 'bitcoin'
+               for terms in pytrend.payloads)
+
+    # the keywords of different payloads are comparable once they are
+    # rescaled to the anchor
+    for keyword in keywords:
+        assert trends[keyword].values == pytest.approx(popularity[keyword])
+
+
+def test_concurrent_windows_keep_their_payloads(cache_name):
+    start, end = datetime(2018, 1, 1), datetime(2018, 3, 1)
+    collector = GoogleTrends('bitcoin', start, end, request_rate=0,
+                             max_workers=4, cache_name=cache_name,
+                             trend_request=lambda hl: SlowTrendReq())
+    collector.compile()
+
+    # every window holds the trends of its own timeframe
+    cache_df = collector.storage.read(start - timedelta(days=5), end)
+    window_end = (cache_df['query_start'] + collector.sample_interval +
+                  collector.overlap_interval)
+    assert not cache_df.empty
+    assert ((cache_df['data_start'] >= cache_df['query_start']) &
+            (cache_df['data_start'] <= window_end)).all()
+
+
+def test_throttled_windows_are_left_uncovered(cache_name):
+    start, end = datetime(2018, 1, 1), datetime(2018, 1, 20)
+    pytrend = ThrottledTrendReq()
+    collector = GoogleTrends('bitcoin', start, end, request_rate=0,
+                             max_retries=1, cache_name=cache_name,
+                             trend_request=lambda hl: pytrend)
+    collector.throttle.base_delay = 0
+
+    # the throttled windows are retried and then left to the next run
+    collector.compile()
+
+    assert len(pytrend.requests) > len(collector.download_intervals())
+    assert not collector.coverage
@@ -0,0 +1,16 @@
+import pandas as pd
+
+from collect.mentions import count_mentions
+
+
+def test_counts_match_str_count():
+    texts = pd.Series(['Buy BTC and btc cash', 'aaaa', None, 'ethereum eth',
+                       'no mention', 'btcbtc'])
+    keywords = ['btc', 'BTC cash', 'aa', 'eth', 'ethereum', 'btc']
+
+    counts_df = count_mentions(texts, keywords)
+
+    for i, keyword in enumerate(keywords):
+        expected = [str(text).lower().count(keyword.lower())
+                    if text is not None else 0 for text in texts]
+        assert counts_df.iloc[:, i].tolist() == expected
@@ -0,0 +1,73 @@
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import pytest
+
+pytest.importorskip('psaw')
+
+from collect.reddit import RedditComments  # noqa: E402
+
+
+Comment = namedtuple('Comment', 'id subreddit author created_utc body')
+
+
+class ExamplePushshift(object):
+
+    def __init__(self, fail_after=None):
+        # a comment every ten minutes. the first search drops its connection
+        # after fail_after comments
+        self.fail_after = fail_after
+        self.searches = []
+
+    def search_comments(self, q, subreddit, filter, after, before,
+                        sort='desc', sort_type=None):
+        self.searches.append(after)
+        fail_after, self.fail_after = self.fail_after, None
+
+        comments = [Comment(str(t), subreddit, 'anon', t,
+                            'buy {0} now'.format(q))
+                    for t in range(after + 1, before, 600)]
+        for i, comment in enumerate(comments):
+            if fail_after is not None and i >= fail_after:
+                raise ConnectionError('connection dropped')
+            yield comment
+
+
+def timestamp(date):
+    return int(date.replace(tzinfo=timezone.utc).timestamp())
+
+
+def test_retried_stream_resumes_from_checkpoint(cache_name):
+    start, end = datetime(2018, 1, 1), datetime(2018, 1, 3)
+    collector = RedditComments('bitcoin', start, end, sample_interval='2d',
+                               stream_chunk_size=50, request_rate=0,
+                               reddit=ExamplePushshift(fail_after=120),
+                               cache_name=cache_name)
+    collector.throttle.base_delay = 0
+
+    compiled_df = collector.compile()
+
+    # the retry starts after the two chunks cached before the failure
+    # rather than from the start of the interval
+    first, retry = collector.reddit.searches[:2]
+    assert first == timestamp(start)
+    assert retry == first + 1 + 99 * 600 - 1
+
+    # every comment is counted once, six to an hour
+    assert (compiled_df['mentions'] == 6).all()
+
+
+def test_streamed_density_counts_every_comment_once(cache_name):
+    start, end = datetime(2018, 1, 1), datetime(2018, 1, 3)
+    collector = RedditComments('bitcoin', start, end, stream_chunk_size=50,
+                               target_rows=200, request_rate=0,
+                               keywords=['btc'], reddit=ExamplePushshift(),
+                               cache_name=cache_name)
+
+    # each interval is mostly cached in chunks before the rest is returned,
+    # and every comment is tagged with both keywords
+    interval_start, interval_end = next(collector.download_intervals())
+    collector.query_interval(interval_start, interval_end)
+
+    assert collector.observed_end == interval_end
+    assert collector.observed_density * 600 == pytest.approx(1, rel=0.01)
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+
+from collect.cache import compile_cache
+
+from .conftest import ExampleComments
+
+
+@pytest.mark.parametrize('storage', ['sqlite', 'parquet'])
+def test_chunked_read_matches_full_read(cache_name, storage):
+    if storage == 'parquet':
+        pytest.importorskip('pyarrow')
+
+    # counting a second keyword bypasses the sqlite mention rollup, so that
+    # both compiles process the raw comments
+    collector = ExampleComments('bitcoin', cache_name, storage=storage,
+                                mention_keywords=['buy'])
+
+    # an interval downloaded again around a covered segment is stored in
+    # a second file holding the same comments
+    start = datetime(2018, 1, 20)
+    for interval_start, interval_end in [(start, start + timedelta(days=5)),
+                                         (start - timedelta(days=10),
+                                          start + timedelta(days=20))]:
+        cache_df = collector.fetch_interval(interval_start, interval_end)
+        collector.cache_interval(interval_start, interval_end, cache_df)
+
+    read_df = collector.storage.read(collector.start_date,
+                                     collector.end_date)
+    chunks = list(collector.storage.read_chunks(collector.start_date,
+                                                collector.end_date, 100))
+    chunked_df = pd.concat(chunks, ignore_index=True)
+
+    assert len(read_df) == 30 * 24
+    pd.testing.assert_frame_equal(
+        read_df.reset_index(drop=True)[['id', 'timestamp']],
+        chunked_df[['id', 'timestamp']])
+
+    # the compiled mentions do not depend on the chunking
+    assert collector.read_processed(collector.start_date,
+                                    collector.end_date) is None
+    compiled_df = collector.compile(download=False)
+    compile_cache.clear()
+    chunked_compile_df = collector.compile(download=False, chunksize=100)
+
+    pd.testing.assert_frame_equal(compiled_df, chunked_compile_df,
+                                  check_dtype=False, check_freq=False)
+    assert compiled_df['mentions'].sum() == 30 * 24
+    assert compiled_df['mentions_buy'].sum() == 30 * 24
+
+
+def test_empty_parquet_read_has_schema_columns(cache_name):
+    pytest.importorskip('pyarrow')
+
+    # nothing has been cached for the keyword
+    collector = ExampleComments('bitcoin', cache_name, storage='parquet')
+    read_df = collector.storage.read(collector.start_date,
+                                     collector.end_date)
+    chunks = list(collector.storage.read_chunks(collector.start_date,
+                                                collector.end_date, 100))
+
+    assert read_df.empty
+    assert {'timestamp', 'text'} <= set(read_df.columns)
+    assert all(set(read_df.columns) == set(chunk.columns)
+               for chunk in chunks)
+
+    compiled_df = collector.compile(download=False)
+    compile_cache.clear()
+    chunked_compile_df = collector.compile(download=False, chunksize=100)
+    assert compiled_df.empty and chunked_compile_df.empty